@@ -13,13 +13,15 @@
 from os import path, makedirs, system
 from time import sleep, time
 from datetime import datetime
-from glob import glob
-import logging, re
+from select import select
+import os, logging, re, json, struct, ctypes, ctypes.util, threading, termios, collections
+import eventstore    # Shared with power-monitor
+from loadscript import load_script
+from debugtime import parse_debug_time  # Shared with console-archive.py
 
 rootfolder = path.expanduser('~')
 consoleLogFolder = path.join(rootfolder,'console_logs')
 logFilePrefix = 'HP501_ttyUSB0.'
-action = False
 bootMsg = 'Boot Successful - Config Ok'
 loginPrompt = 'login:'
 passPrompt = 'Password:'
@@ -32,10 +34,33 @@ ykdebugFile = '/mnt/root/ykDebug'
 username = 'admin'
 password = 'admin'
 timeout = 25    # time in seconds to wait for new log data
-drift = 5       # seconds of drift allowed
+pollInterval = 1    # seconds between checks for new log data without inotify
+rescanInterval = 10 # seconds between scans for new logfiles without inotify
+settleTime = 0.15   # seconds a line without newline is held back, unless it is a prompt
+drift = 5       # seconds of drift allowed before the clock is stepped in 'step' mode
 chkTimeInterval = 300      # time in seconds to recheck local clock sync (300 = 5min)
 eagerbeaver = True         # Force time to update immediate
 lastTime = datetime(1970,1,1)       # timestamp for syncing time -- Use epoch to start
+ruleFile = path.join(rootfolder,'console-rules.json')   # Extra prompt rules, see load_rules()
+consoleMode = 'screen'          # 'screen' sends keys to the screen session, 'serial' owns serialDevice
+serialDevice = '/dev/ttyUSB0'   # Console port for serial mode, 'pty' starts a FakeConsole
+serialBaud = 9600
+stateTimeouts = {'booting': 10, 'login': 5, 'password': 2, 'loggedin': 5, 'debug': 60}   # first deadline in each login state (seconds), doubled on every retry
+maxBackoff = 120    # longest wait between retries in seconds
+maxRetries = 6      # retries before starting the login over
+stateFile = path.join(rootfolder,'console-state.json')   # Current login state and transition times
+archiveFolder = None    # Compress finished logfiles into this folder, None disables the archiver
+archiveAge = 3600       # seconds without writes before a logfile counts as finished
+archiveChunk = 65536    # bytes of log per gzip member, the unit a search reads back
+archiveInterval = 600   # seconds between archive runs
+clockMode = 'slew'      # 'step' sets the clock with date -s, 'slew' adjusts it with adjtime(), 'offset' only writes offsetFile
+clockStepLimit = 60     # seconds of offset that are stepped even in 'slew' mode, e.g. no RTC after a reboot
+slewTolerance = 0.5     # seconds of offset left alone in 'slew' mode
+cannotSlew = False      # set when adjtime() fails (not root), 'slew' mode then steps above drift like 'step'
+clockWindow = 3600      # seconds of timestamp samples used to fit offset and rate
+offsetFile = path.join(rootfolder,'console-clock.json')    # Current console - local offset and rate for other programs
+clockHistory = path.join(rootfolder,'console-clock.csv')   # One line per clock check, for analysis
+eventFile = eventstore.eventfile    # Shared event store with power-monitor, None disables it
 
 
 #----- Basic Logging -----#
@@ -47,59 +72,181 @@ logging.basicConfig(level=logging.INFO,
 
 ################### ---- START CODE -------- ###################################
 
+class LogIndex(object):
+    # In-memory index of the screen logfiles in a folder: name -> mtime
+    # The folder is scanned once, after that the index follows the
+    # inotify events seen by follow(), or rescan() when polling
+
+    def __init__(self, folder, prefix):
+        self.folder = folder
+        self.prefix = prefix
+        self.files = {}
+        self.lastscan = 0
+        self.scan()
+
+    def scan(self):
+        ## Full scan, only stat the files that are not known yet
+        ## Returns the names that are new
+        names = [f for f in os.listdir(self.folder) if f.startswith(self.prefix)]
+        new = []
+        for name in names:
+            if name in self.files: continue
+            try:
+                st = os.stat(path.join(self.folder, name))
+            except OSError:
+                continue
+            if not path.isfile(path.join(self.folder, name)): continue
+            self.files[name] = st.st_mtime
+            new.append(name)
+        for name in set(self.files) - set(names):
+            del self.files[name]
+        self.lastscan = time()
+        logging.debug('LogIndex: %d files, new=%s',len(self.files),new)
+        return new
+
+    def rescan(self, interval):
+        ## Polling fallback, scan at most every interval seconds
+        if time() - self.lastscan < interval: return []
+        return self.scan()
+
+    def event(self, mask, name):
+        ## Apply an inotify event, returns True when name is a new logfile
+        if not name.startswith(self.prefix): return False
+        if mask & (IN_DELETE | IN_MOVED_FROM):
+            self.files.pop(name, None)
+            return False
+        new = name not in self.files
+        self.files[name] = time()
+        return new and bool(mask & (IN_CREATE | IN_MOVED_TO))
+
+    def newest(self):
+        if not self.files: return ''
+        return path.join(self.folder, max(self.files, key=self.files.get))
+
+
+logIndex = None
+
+
+def log_index(folder):
+    # The LogIndex for folder, created on first use
+    global logIndex
+    if logIndex is None or logIndex.folder != folder:
+        logIndex = LogIndex(folder, logFilePrefix)
+    return logIndex
+
+
 def newLog(root_path):
     # Find the most recent log
-    all_files = [path.join(root_path,f) for f in glob(path.join(root_path,logFilePrefix+"*"))
-                    if path.isfile(path.join(root_path,f))]
-
-    logging.debug('all_files=%s',all_files)
     #Check for empty results
-    if len(all_files) > 0:
-        return max(all_files, key=path.getmtime)
-    else:
-        return ''
+    return log_index(path.abspath(root_path)).newest()
+
+
+events = eventstore.EventStore(eventFile, 'console', sessionID)     # Opened by the first event
+publish = events.publish
+
+
+class timeval(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_usec', ctypes.c_long)]
+
+
+def adjtime(seconds):
+    # Slew the system clock by seconds through adjtime(2), needs root
+    # Returns the part of the previous adjustment that was still pending
+    libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+    sec = int(seconds // 1)
+    delta = timeval(sec, int((seconds - sec) * 1000000))
+    old = timeval()
+    if libc.adjtime(ctypes.byref(delta), ctypes.byref(old)) < 0:
+        e = ctypes.get_errno()
+        raise OSError(e, os.strerror(e))
+    return old.tv_sec + old.tv_usec / 1000000.0
+
+
+class ClockDrift(object):
+    # Console - local clock offset from the debug timestamps
+    # Every timestamp line is a sample, a least squares line through the
+    # samples of the last window seconds gives the offset now and the rate
+    # The console prints whole seconds, +0.5 centers the sample
+    # Samples are dropped after a correction, they describe the old clock
+
+    def __init__(self, window):
+        self.window = window
+        self.samples = collections.deque()
+
+    def add(self, line, local=None):
+        remote = parse_debug_time(line)
+        if remote is None or remote < 1451606400:
+            ## Unset console clock (before 2016) or a zone we cannot convert
+            return None
+        if local is None: local = time()
+        offset = remote + 0.5 - local
+        self.samples.append((local, offset))
+        while self.samples and self.samples[0][0] < local - self.window:
+            self.samples.popleft()
+        return offset
+
+    def fit(self, now=None):
+        # (offset now, rate in s/s, samples), None without samples
+        samples = list(self.samples)
+        if not samples: return None
+        if now is None: now = time()
+        n = len(samples)
+        mt = sum(t for t, o in samples) / n
+        mo = sum(o for t, o in samples) / n
+        stt = sum((t - mt) ** 2 for t, o in samples)
+        rate = 0.0
+        ## A rate from less than a minute of samples is mostly jitter
+        if samples[-1][0] - samples[0][0] >= 60 and stt > 0:
+            rate = sum((t - mt) * (o - mo) for t, o in samples) / stt
+        return mo + rate * (now - mt), rate, n
+
+    def reset(self):
+        self.samples.clear()
+
+
+clockDrift = ClockDrift(clockWindow)
 
 
 def syncRemoteTime(line):
-    # Use the time from the remote console to update local system time
-    # Also update hwclock on local system
-    global drift, lastTime, eagerbeaver
+    # Use the time from the remote console to correct the local system time
+    # The offset comes from the drift fit over all recent timestamps, small
+    # offsets are slewed so the clock never jumps, see clockMode
+    global lastTime, eagerbeaver, cannotSlew
 
     ## Removed - just adds extra noise to log file
     #logging.info('Checking for clock sync...')
 
-    ## remove the *** and whitespace padding
-    r = line.strip("*").rstrip().lstrip()
-    logging.debug('Stripped and Formated: [%s]',r)
-    ## convert into a datetime string expecting the format: "MM/DD/YY HH:MM:SS TZ"
-    remoteTime = datetime.strptime(r, "%m/%d/%y %H:%M:%S %Z")
+    result = clockDrift.fit()
+    if result is None:
+        logging.debug('No clock samples yet [%s]',line)
+        return None
+    offset, rate, n = result
+    logging.debug('remote-local offset = %.3f rate = %.1fppm (%d samples)',offset,rate * 1e6,n)
 
-    ## Check the current local system time
-    localTime = datetime.now()
-
-    logging.debug('Last clock check happend at: %s',lastTime)
-    logging.debug('Remote Time is "%s"',remoteTime)
-    logging.debug('Local Time is "%s"',localTime)
-
-    ## Calculate a positive drift value between both clocks
-    rldrift = (remoteTime-localTime).total_seconds()
-    logging.debug('remote-local drift = %d',rldrift)
-    ## Only update when the clocks are out of sync and the new time is recent
-    if rldrift > drift and remoteTime.year >= 2016:
-        ## Clocks are out of Sync
-        logging.info('Clocks are out of sync by: %d seconds',rldrift)
-        ## Update the local system time
-        syscmd = 'sudo date -s "%s"' %remoteTime
-        o = system(syscmd)
-        logging.debug('Updated local system: %s',o)
-        ## Update the hardware clock too
-        o = system('sudo hwclock -w --utc')
-        logging.debug('Updated HWclock: %s',o)
-        localTime = datetime.now()
-        logging.info('Local Time set -- %s',localTime)
+    action = 'none'
+    slewing = clockMode == 'slew' and not cannotSlew
+    if clockMode in ('step', 'slew') and abs(offset) > (clockStepLimit if slewing else drift):
+        action = step_clock(offset)
+    elif slewing and abs(offset) > slewTolerance:
+        try:
+            pending = adjtime(offset)
+            logging.info('Clocks are out of sync by: %.3f seconds, slewing (%.3f was pending)',offset,pending)
+            clockDrift.reset()
+            action = 'slew'
+        except OSError as e:
+            ## Not root, step through sudo like 'step' mode from now on
+            logging.warn('adjtime failed (%s), stepping offsets over %ds with sudo date',e,drift)
+            cannotSlew = True
+            if abs(offset) > drift: action = step_clock(offset)
+    elif clockMode == 'offset':
+        logging.info('Console clock offset %.3fs, rate %.1fppm',offset,rate * 1e6)
     else:
         ## Clocks are fine
-        logging.info('Clocks Sync is OK')
+        logging.info('Clocks Sync is OK (%.3fs)',offset)
+
+    localTime = datetime.now()
+    write_clock(localTime, offset, rate, n, action)
+    if action != 'none': publish('clock', value=offset, detail={'action': action, 'rate_ppm': rate * 1e6})
 
     ## Clocks have been checked, update memory
     lastTime = localTime
@@ -111,10 +258,210 @@ def syncRemoteTime(line):
     return localTime
 
 
+def step_clock(offset):
+    ## Clocks are out of Sync
+    logging.info('Clocks are out of sync by: %.1f seconds, stepping',offset)
+    ## Update the local system time
+    o = system('sudo date -s "@%.3f"' %(time() + offset))
+    logging.debug('Updated local system: %s',o)
+    ## Update the hardware clock too
+    o = system('sudo hwclock -w --utc')
+    logging.debug('Updated HWclock: %s',o)
+    clockDrift.reset()
+    return 'step'
+
+
+def write_clock(localTime, offset, rate, n, action):
+    # Publish the offset for other programs and keep the history
+    now = time()
+    data = {'offset': offset, 'rate_ppm': rate * 1e6, 'samples': n,
+            'updated': now, 'mode': clockMode, 'action': action}
+    try:
+        if offsetFile:
+            tmp = offsetFile + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(data, f, sort_keys=True)
+            os.rename(tmp, offsetFile)
+        if clockHistory:
+            new = not path.exists(clockHistory)
+            with open(clockHistory, 'a') as f:
+                if new: f.write('time,offset,rate_ppm,samples,action\n')
+                f.write('%.3f,%.3f,%.3f,%d,%s\n' %(now, offset, rate * 1e6, n, action))
+    except (IOError, OSError) as e:
+        logging.debug('Could not write clock files: %s',e)
+
+
+class SerialConsole(object):
+    # Own the console serial port directly instead of going through screen
+    # A reader thread copies everything received into a new logfile in
+    # folder, named like the screen logs, so follow() works the same way
+    # send() writes straight to the port, no shell or screen process per key
+    # A lost device (USB unplugged) is reopened every retry seconds
+
+    def __init__(self, device, baud, folder, prefix, retry=5):
+        self.device = device
+        self.baud = baud
+        self.folder = folder
+        self.prefix = prefix
+        self.retry = retry
+        self.fd = None
+        self.log = None
+        self.running = False
+
+    def open(self):
+        fd = os.open(self.device, os.O_RDWR | os.O_NOCTTY | os.O_NONBLOCK)
+        ## Raw 8N1, no echo or line editing
+        attrs = termios.tcgetattr(fd)
+        attrs[0] = termios.IGNPAR
+        attrs[1] = 0
+        attrs[2] = termios.CS8 | termios.CREAD | termios.CLOCAL
+        attrs[3] = 0
+        attrs[4] = attrs[5] = getattr(termios, 'B%d' %self.baud)
+        attrs[6][termios.VMIN] = 0
+        attrs[6][termios.VTIME] = 0
+        termios.tcsetattr(fd, termios.TCSANOW, attrs)
+        self.fd = fd
+        logging.info('Opened serial console %s at %d baud',self.device,self.baud)
+
+    def newlog(self):
+        ## Start a logfile like screen does for a new session
+        if not path.isdir(self.folder): makedirs(self.folder)
+        name = path.join(self.folder, self.prefix + datetime.now().strftime('%Y%m%d-%H%M%S'))
+        self.log = open(name, 'ab')
+        logging.info('Logging serial console to %s',name)
+        return name
+
+    def start(self):
+        self.open()
+        self.newlog()
+        self.running = True
+        t = threading.Thread(target=self.reader, name='serial-console')
+        t.daemon = True
+        t.start()
+        return self
+
+    def reader(self):
+        while self.running:
+            try:
+                if self.fd is None:
+                    sleep(self.retry)
+                    self.open()
+                if not select([self.fd], [], [], 1)[0]: continue
+                data = os.read(self.fd, 4096)
+                if not data:
+                    ## Hangup, the device went away
+                    raise OSError('serial device closed')
+                self.log.write(data)
+                self.log.flush()
+            except (OSError, IOError, termios.error) as e:
+                logging.warn('Serial console %s: %s',self.device,e)
+                self.close_fd()
+
+    def send(self, value):
+        ## Write value and a carriage return, waiting up to 1s for the port
+        if self.fd is None:
+            logging.warn('Serial console %s is not open',self.device)
+            return False
+        data = (value + '\r').encode('utf-8')
+        try:
+            while data:
+                if not select([], [self.fd], [], 1)[1]:
+                    logging.warn('Serial console write timed out')
+                    return False
+                data = data[os.write(self.fd, data):]
+            return True
+        except (OSError, IOError) as e:
+            logging.warn('Serial console write Error: %s',e)
+            return False
+
+    def close_fd(self):
+        if self.fd is not None:
+            try:
+                os.close(self.fd)
+            except OSError:
+                pass
+        self.fd = None
+
+    def close(self):
+        self.running = False
+        self.close_fd()
+        if self.log is not None: self.log.close()
+
+
+class FakeConsole(object):
+    # Pseudo-tty stand-in for the HP501 console, for testing serial mode
+    # Use the path from start() as serialDevice
+    # Prints the boot message, answers the login and password prompts,
+    # gives a root prompt and prints debug timestamps once ykDebug runs
+    # Output is written in small chunks, see say()
+
+    def __init__(self, interval=5):
+        self.interval = interval
+        self.master, self.slave = os.openpty()
+        self.name = os.ttyname(self.slave)
+        self.state = 'login'
+
+    def start(self):
+        t = threading.Thread(target=self.run, name='fake-console')
+        t.daemon = True
+        t.start()
+        return self.name
+
+    def say(self, text):
+        ## A few bytes at a time at about serialBaud, like a real port,
+        ## so the logfile gets lines in pieces
+        data = text.encode('utf-8')
+        for i in range(0, len(data), 4):
+            os.write(self.master, data[i:i+4])
+            sleep(40.0 / serialBaud)
+
+    def run(self):
+        ## Give follow() time to open the logfile
+        sleep(1)
+        self.say('\r\nBooting...\r\n%s\r\n' %bootMsg)
+        buf = b''
+        lasttick = time()
+        while True:
+            if select([self.master], [], [], 1)[0]:
+                buf += os.read(self.master, 1024)
+            while b'\r' in buf:
+                line, buf = buf.split(b'\r', 1)
+                self.answer(line.decode('utf-8', 'replace'))
+            if self.state == 'debug' and time() - lasttick >= self.interval:
+                lasttick = time()
+                self.say('****** %s ******\r\n' %datetime.utcnow().strftime('%m/%d/%y %H:%M:%S UTC'))
+
+    def answer(self, line):
+        if self.state == 'login':
+            if line == username:
+                self.state = 'password'
+                self.say('%s\r\n%s ' %(line, passPrompt))
+            else:
+                self.say('\r\nHP501 %s ' %loginPrompt)
+        elif self.state == 'password':
+            if line == password:
+                self.state = 'root'
+                self.say('\r\n%s\r\nHP501#\r\n' %loginsuccess)
+            else:
+                self.state = 'login'
+                self.say('\r\nLogin incorrect\r\nHP501 %s ' %loginPrompt)
+        elif self.state == 'root':
+            if line == ykdebugFile:
+                self.state = 'debug'
+            self.say('%s\r\nHP501#\r\n' %line)
+
+
+serialConsole = None
+
+
 def send_screen_cmd(value):
     # Send a command to the screen session
     # value will be sent to the session
     global sessionID
+    if serialConsole is not None:
+        ## Direct serial connection, no screen process needed
+        logging.debug('send serial: %s',value)
+        return serialConsole.send(value)
     ## setup the screen cmd
     #crlf = "$(printf \\r)"
     #crlf = "$(echo -ne '\015')"
@@ -130,96 +477,469 @@ def send_screen_cmd(value):
         return False
 
 
+def send_pause(seconds):
+    # Wait between keys sent to the console
+    # The supervisor replaces this to queue the pause with its keys
+    sleep(seconds)
+
+
+## inotify event masks from <sys/inotify.h>
+IN_MODIFY = 0x002
+IN_CLOSE_WRITE = 0x008
+IN_MOVED_FROM = 0x040
+IN_MOVED_TO = 0x080
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+
+class Inotify(object):
+    # Minimal inotify binding through libc
+    # Raises OSError when inotify is not available
+
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+
+    def add_watch(self, pathname, mask):
+        wd = self.libc.inotify_add_watch(self.fd, pathname.encode('utf-8'), mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_add_watch failed: %s' %pathname)
+        return wd
+
+    def read(self, wait):
+        ## Wait up to wait seconds, return a list of (wd, mask, name)
+        ready = select([self.fd], [], [], wait)[0]
+        if not ready:
+            return []
+        try:
+            data = os.read(self.fd, 65536)
+        except OSError:
+            return []
+        events = []
+        pos = 0
+        while pos + 16 <= len(data):
+            wd, mask, cookie, size = struct.unpack_from('iIII', data, pos)
+            name = data[pos+16:pos+16+size].rstrip(b'\0').decode('utf-8', 'replace')
+            events.append((wd, mask, name))
+            pos += 16 + size
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class LogWatch(object):
+    # Wait for changes in the folder of the followed logfile
+    # Uses inotify so appends wake up the reader at once,
+    # falls back to sleeping pollInterval seconds
+
+    def __init__(self, folder):
+        self.folder = folder
+        try:
+            self.inotify = Inotify()
+            self.inotify.add_watch(folder, IN_MODIFY | IN_CLOSE_WRITE | IN_CREATE |
+                                   IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO)
+        except (OSError, AttributeError) as e:
+            logging.info('inotify not available, polling for log data (%s)',e)
+            self.inotify = None
+
+    def wait(self, seconds):
+        ## Return the (mask, name) events seen, or None when polling
+        if self.inotify is None:
+            sleep(min(seconds, pollInterval))
+            return None
+        return [(mask, name) for wd, mask, name in self.inotify.read(seconds)]
+
+    def close(self):
+        if self.inotify is not None: self.inotify.close()
+
+
+def reopen(thefile):
+    # Keep following the same path when the file was truncated or replaced
+    # Only called once the current file has been read to the end
+    try:
+        st = os.stat(thefile.name)
+    except OSError:
+        ## Removed or rotated away, stay on the old file until it is back
+        return thefile
+    if st.st_ino != os.fstat(thefile.fileno()).st_ino:
+        logging.info('Logfile replaced, reopening %s',thefile.name)
+        newfile = open(thefile.name, 'r')
+        thefile.close()
+        return newfile
+    if st.st_size < thefile.tell():
+        logging.info('Logfile truncated, reading %s from the start',thefile.name)
+        thefile.seek(0)
+    return thefile
+
+
+class LogFollower(object):
+    # The non-blocking part of follow(), also used by console-supervisor.py
+    #  lines() reads whatever is in the logfile now, complete lines at once
+    #  A line without newline is held back until it is completed, looks
+    #  like a prompt, or nothing was written for settleTime seconds;
+    #  screen and the serial port flush in the middle of lines
+    #  events() takes the LogWatch events and notes a newer logfile,
+    #  the old one is finished before lines() moves over to it
+    #  idle() sends the wakeup after timeout and returns how long to wait
+
+    def __init__(self, thefile):
+        thefile.seek(0,2)      # Go to the end of the file
+        self.file = thefile
+        self.folder = path.dirname(path.abspath(thefile.name))
+        self.index = log_index(self.folder)
+        self.lastline = time()
+        self.newfile = None
+        self.partial = ''
+
+    def lines(self, limit=None):
+        out = []
+        while limit is None or len(out) < limit:
+            line = self.file.readline()
+            if line:
+                ## reset timeout
+                self.lastline = time()
+                if line.endswith('\n'):
+                    out.append(self.partial + line)
+                    self.partial = ''
+                else:
+                    self.partial += line
+                continue
+
+            ## Pass on a held back line once it is a prompt or has settled
+            if self.partial and (time() - self.lastline >= settleTime or
+                                 self.newfile is not None or is_prompt(self.partial)):
+                out.append(self.partial)
+                self.partial = ''
+
+            ## Old file is drained, hand over to the new one from its start
+            if self.newfile is not None:
+                logging.info('Monitoring Console Logfile: %s',self.newfile)
+                self.file.close()
+                self.file = open(self.newfile, 'r')
+                self.newfile = None
+                continue
+
+            ## Nothing left, check for truncation or a new file
+            pos = self.file.tell()
+            f = reopen(self.file)
+            if f is not self.file or f.tell() != pos:
+                self.file = f
+                continue
+            break
+        return out
+
+    def idle(self):
+        ## Keep a timeout
+        delay = time() - self.lastline
+        logging.debug('delay=%d',delay)
+        ## send a wakeup to the console
+        if delay >= timeout:
+            logging.debug('timeout exceeded (%d)',delay)
+            send_screen_cmd('')
+            ## Reset the delay before moving on
+            self.lastline = time()
+            delay = 0
+        ## Wake up for the timeout or the next login deadline
+        wait = timeout - delay
+        if machine is not None and machine.deadline is not None:
+            wait = min(wait, max(0, machine.deadline - time()))
+        if self.partial:
+            ## Or when the held back line has settled
+            wait = min(wait, max(0, settleTime - (time() - self.lastline)))
+        return wait
+
+    def events(self, events):
+        if events is None:
+            new = self.index.rescan(rescanInterval)
+        else:
+            new = [name for mask, name in events if self.index.event(mask, name)]
+        for name in new:
+            if path.join(self.folder, name) != path.abspath(self.file.name):
+                self.newfile = path.join(self.folder, name)
+
+    def close(self):
+        self.file.close()
+
+
 def follow(thefile):
     # Logic flow:
     #  Open the logfile and look at the last line
-    #  When there is no line to read, sleep before re-reading the file
+    #  When there is no line to read, wait for the file to change
     #  Finally output the line
-    global action, timeout
-    delay = 0
-    thefile.seek(0,2)      # Go to the end of the file
-    while True:
-        ## Keep reading lines and spit it out
-         line = thefile.readline()
-         if not line:
-            ## Keep a timeout
-            delay += 1
-            logging.debug('delay=%d',delay)
-            ## send a wakeup to the console
-            if delay == timeout:
-                logging.debug('timeout exceeded (%d)',delay)
-                send_screen_cmd('')
-                ## Reset the delay before moving on
-                delay = 0
-            ## Sleep for 1s
-            sleep(1)
-            continue
-         else:
-            ## reset timeout
-            delay = 0
-            yield line
+    #  Prompts like 'login: ' have no newline, see LogFollower for partial lines
+    #  When screen starts a new logfile, finish the old one and move over
+    #  An empty line is yielded after every wait so login deadlines are
+    #  checked while the console is quiet
+    follower = LogFollower(thefile)
+    watch = LogWatch(follower.folder)
+    try:
+        while True:
+            ## Keep reading lines and spit it out
+            for line in follower.lines():
+                yield line
+            ## Sleep until the file changes, the timeout is due or the next tick
+            events = watch.wait(follower.idle())
+            yield ''
+            follower.events(events)
+    finally:
+        watch.close()
 
 
-def interAction(t,logval):
-    # When action=True Go interact with the screen console
-    global action, loginPrompt, passPrompt, username, password, rootPrompt, ykdebugFile, loginsuccess
+class LineClassifier(object):
+    # Classify a console line into an event, first matching rule wins
+    # rules are dicts in priority order:
+    #   event   - name of the event, see handlers
+    #   match   - 'text' substring, 'regex' regex from the line start,
+    #             'search' regex anywhere in the line
+    #   pattern - the text or regex
+    #   send    - optional text sent to the console when the event is 'send'
+    # Text rules are plain 'in' checks and regexes are compiled once, so a
+    # line that matches nothing costs about what the old elif chain did
 
-    ## Time to execute I/O
-    logging.debug('Action = %s',action)
+    def __init__(self, rules):
+        self.rules = list(rules)
+        self.table = []
+        for rule in self.rules:
+            kind = rule.get('match', 'text')
+            pattern = rule['pattern']
+            if kind == 'text':
+                test = pattern
+            elif kind == 'search':
+                test = re.compile(pattern).search
+            elif kind == 'regex':
+                test = re.compile(pattern).match
+            else:
+                raise ValueError('Unknown match type %s in rule %s' %(kind, rule))
+            self.table.append((kind == 'text', test, rule))
 
-    ## Look for a boot message
-    ## Only restart debugging when a boot is detected
-    if bootMsg in logval:
-        # Upon first boot hold back and just wait
-        logging.info('Bootup Finished.')
-        ## Force a login prompt by sending "enter" key
-        logging.debug('Sending Enter to find a login prompt')
-        send_screen_cmd('')
+    def classify(self, line):
+        ## Return the rule matching line, or None
+        for text, test, rule in self.table:
+            if text:
+                if test in line: return rule
+            elif test(line):
+                return rule
+        return None
+
+
+def load_rules(filename):
+    # Rules from a JSON list in filename are checked before the default rules
+    # e.g. [{"event": "login", "match": "text", "pattern": "Username:"}]
+    rules = []
+    if filename and path.isfile(filename):
+        with open(filename) as f:
+            rules = json.load(f)
+        logging.info('Loaded %d console rules from %s',len(rules),filename)
+    return rules + [
+        {'event': 'boot', 'match': 'text', 'pattern': bootMsg},
+        {'event': 'login', 'match': 'text', 'pattern': loginPrompt},
+        {'event': 'password', 'match': 'text', 'pattern': passPrompt},
+        {'event': 'loggedin', 'match': 'text', 'pattern': loginsuccess},
+        {'event': 'root', 'match': 'regex', 'pattern': rootPrompt.pattern},
+        {'event': 'timestamp', 'match': 'regex', 'pattern': debugtimestamp.pattern},
+        ]
+
+
+def onBoot(logval, rule):
+    # Upon first boot hold back and just wait
+    logging.info('Bootup Finished.')
+    publish('boot')
+    ## Force a login prompt by sending "enter" key
+    logging.debug('Sending Enter to find a login prompt')
+    send_screen_cmd('')
+
+
+def onLogin(logval, rule):
+    logging.debug('login found - [%s]',logval)
+    ## send the login name
+    send_screen_cmd(username)
+
+
+def onPassword(logval, rule):
+    logging.debug('password found - [%s]',logval)
+    send_screen_cmd(password)
+    ## wait a bit and give 2 keypresses
+    send_pause(0.1)
+    send_screen_cmd('')
+    send_screen_cmd('')
+
+
+def onLoggedIn(logval, rule):
+    ## Successful login
+    logging.info('Logged in as %s',username)
+    publish('login')
 
-    ## Time to find what value is inside logval and handle it appropriately
-    ## Look for login prompt
-    elif loginPrompt in logval:
-        logging.debug('login found - [%s]',logval)
-        ## send the login name
-        send_screen_cmd(username)
-    ## Test for password prompt
-    elif passPrompt in logval:
-        logging.debug('password found - [%s]',logval)
-        send_screen_cmd(password)
-        ## wait a bit and give 2 keypresses
-        sleep(0.1)
-        send_screen_cmd('')
-        send_screen_cmd('')
-    ## Check for successfull login
-    elif loginsuccess in logval:
-        ## Successful login
-        logging.info('Logged in as %s',username)
 
-    ## Look for a root prompt
-    ## Use reg-ex to match the root prompt
+def onRoot(logval, rule):
     ## Multiple actions will occur once we have a root prompt
-    elif rootPrompt.match(logval):
+    ## time to start the debug script
+    if send_screen_cmd(ykdebugFile):
+        logging.debug('ykDebug started')
+        logging.info('Debug code started on HP501')
+        return True
+    return False
 
-        ## time to start the debug script
-        if send_screen_cmd(ykdebugFile):
-            logging.debug('ykDebug started')
-            logging.info('Debug code started on HP501')
 
-            ## Done - reset action
-            action = False
-            logging.debug('Action Reset = %s',action)
-    else:
-        ## Sleep, send linefeed and try again
-        #logging.debug('sleeping - Action=True')
-        logging.debug('Action True - Nothing found (%d)[%s]',t,logval)
-        #sleep(1)
-        #send_screen_cmd('')
+def onSend(logval, rule):
+    ## Rule from the config with its own reply
+    logging.debug('%s found - [%s]',rule['pattern'],logval)
+    send_screen_cmd(rule.get('send', ''))
+
+
+# Login states, each one waits for the next step:
+#   idle     - nothing to do, waiting for a boot message or login prompt
+#   booting  - boot finished, Enter sent to get a login prompt
+#   login    - username sent, waiting for the password prompt
+#   password - password sent, waiting for the banner or a root prompt
+#   loggedin - banner seen, waiting for a root prompt
+#   debug    - ykDebug sent, waiting for its first timestamp
+#   running  - debug timestamps are coming in
+activeStates = ('booting', 'login', 'password', 'loggedin', 'debug')
+
+# event -> (handler, next state, states the event is handled in)
+# None as next state stays put, None as states handles it in any state
+transitions = {
+    'boot': (onBoot, 'booting', None),
+    'login': (onLogin, 'login', None),
+    'password': (onPassword, 'password', None),
+    'loggedin': (onLoggedIn, 'loggedin', activeStates),
+    'root': (onRoot, 'debug', ('booting', 'login', 'password', 'loggedin')),
+    'timestamp': (None, 'running', ('idle', 'debug')),
+    'send': (onSend, None, activeStates),
+    }
+classifier = None
+# Events of rules that match a prompt, passed on without waiting for a newline
+promptEvents = ('login', 'password', 'root', 'send')
+
+
+def is_prompt(line):
+    if classifier is None: return False
+    rule = classifier.classify(line.strip())
+    return rule is not None and rule['event'] in promptEvents
+
+
+class LoginMachine(object):
+    # Drive the console from boot to a running ykDebug
+    # Every active state has a deadline from timeouts, when it passes
+    # Enter is sent to get a fresh prompt and the deadline doubles, up to
+    # backoff seconds. After retries the login starts over from booting.
+    # Time spent in each state is kept per transition and written to
+    # statefile with the current state so a stuck console is visible
+
+    def __init__(self, timeouts, backoff=maxBackoff, retries=maxRetries, statefile=None):
+        self.timeouts = timeouts
+        self.backoff = backoff
+        self.maxretries = retries
+        self.statefile = statefile
+        self.state = 'idle'
+        self.since = time()
+        self.deadline = None
+        self.retries = 0
+        self.bootstart = None
+        self.timings = {}
+
+    def enter(self, state, now=None):
+        if now is None: now = time()
+        ## Timing for the transition just finished
+        spent = now - self.since
+        key = '%s->%s' %(self.state, state)
+        t = self.timings.setdefault(key, {'count': 0, 'total': 0.0, 'max': 0.0, 'last': 0.0})
+        t['count'] += 1
+        t['total'] += spent
+        t['max'] = max(t['max'], spent)
+        t['last'] = spent
+        logging.info('Console state %s -> %s after %.2fs',self.state,state,spent)
+
+        if state == 'booting':
+            self.bootstart = now
+        elif state == 'running' and self.bootstart is not None:
+            logging.info('Debug running %.1fs after boot',now - self.bootstart)
+            publish('debug', ts=now * 1000, value=now - self.bootstart)
+            self.timings['boot->running'] = {'last': now - self.bootstart}
+            self.bootstart = None
+
+        self.state = state
+        self.since = now
+        self.retries = 0
+        wait = self.timeouts.get(state)
+        self.deadline = now + wait if wait else None
+        self.save()
+
+    def event(self, event, logval, rule):
+        # Handle a classified console line, returns True when it was used
+        if event not in transitions:
+            return False
+        handler, state, states = transitions[event]
+        allowed = states is None or self.state in states
+        ## A root prompt after a debug retry means ykDebug is not running
+        if event == 'root' and self.state == 'debug' and self.retries:
+            allowed = True
+        if not allowed:
+            logging.debug('Ignoring %s in state %s - [%s]',event,self.state,logval)
+            return False
+        if handler is not None and handler(logval, rule) is False:
+            ## Action failed, the deadline will retry it
+            return False
+        if state is not None:
+            self.enter(state)
+        return True
+
+    def check(self, now=None):
+        # Retry the current state when its deadline has passed
+        if now is None: now = time()
+        if self.deadline is None or now < self.deadline:
+            return False
+        self.retries += 1
+        publish('stuck', ts=now * 1000, value=now - self.since, detail={'state': self.state, 'retry': self.retries})
+        if self.retries > self.maxretries:
+            logging.warn('Console stuck in %s for %.0fs, starting login over',self.state,now - self.since)
+            self.enter('booting', now)
+        else:
+            wait = min(self.timeouts[self.state] * 2 ** self.retries, self.backoff)
+            logging.warn('Console stuck in %s for %.0fs, retry %d in %ds',self.state,now - self.since,self.retries,wait)
+            self.deadline = now + wait
+            self.save()
+        ## Enter gives a fresh prompt for whatever the console is waiting on
+        send_screen_cmd('')
+        return True
+
+    def save(self):
+        if not self.statefile: return
+        data = {'state': self.state, 'since': self.since, 'retries': self.retries,
+                'deadline': self.deadline, 'timings': self.timings}
+        try:
+            tmp = self.statefile + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(data, f, indent=1, sort_keys=True)
+            os.rename(tmp, self.statefile)
+        except (IOError, OSError) as e:
+            logging.debug('Could not write %s: %s',self.statefile,e)
+
+
+machine = None
+
+
+def interAction(t,logval,rule=None):
+    # Go interact with the screen console for a console line
+    ## Time to find what value is inside logval and handle it appropriately
+    if rule is None: rule = classifier.classify(logval)
+    if rule is None or not machine.event(rule['event'], logval, rule):
+        logging.debug('State %s - Nothing done (%d)[%s]',machine.state,t,logval)
 
 
 def consume_lines(loglines):
     # process each log line
     # This will look for keywords to force actions
-    global action, bootMsg, loginPrompt, passPrompt, timeout, chkTimeInterval, lastTime, debugtimestamp, eagerbeaver
+    # Every line is classified once, then the event decides what happens
+    global classifier, machine, timeout, chkTimeInterval, lastTime, eagerbeaver
+
+    if classifier is None: classifier = LineClassifier(load_rules(ruleFile))
+    if machine is None: machine = LoginMachine(stateTimeouts, statefile=stateFile)
 
     ## loop through each log line
     for t,line in enumerate(loglines):
@@ -228,29 +948,27 @@ def consume_lines(loglines):
             logval = line.strip()
             #logval = line
 
+            ## Retry a login step that is overdue
+            machine.check()
+            ## Idle tick from follow()
+            if not logval: continue
+
             ## Show what line was last consumed
             logging.debug('(%d) %s',t,line)
 
-            ## Key things to look for to start actions
-            bootup = (bootMsg,loginPrompt,passPrompt)
-            if any(x in line for x in bootup):
-                ## Found something
-                logging.debug('Found bootup action in line [%s]',logval)
-                ## Found a boot start - time to force a login
-                action = True
+            rule = classifier.classify(logval)
+            event = rule['event'] if rule else None
 
-            ## When action is true, go do an action
-            ## Plan on this being looped for each log line
-            if action:
-                ## Send the log data to process for interaction with the screen session
-                interAction(t,logval)
-
-            ## end of if statement
+            ## Send the log data to the login state machine
+            if rule is not None:
+                interAction(t,logval,rule)
 
             ## Look for a timestamp from the debug output
-            if debugtimestamp.match(logval):
+            if event == 'timestamp':
                 ## Found a timestamp line
                 logging.debug('Timestamp Found: [%s]',logval)
+                ## Every timestamp is a clock sample
+                clockDrift.add(logval)
                 t1 = datetime.now()
                 ## How many seconds has it been since last check
                 nowdrift = abs((t1 - lastTime).total_seconds())
@@ -268,11 +986,39 @@ def consume_lines(loglines):
             raise
 
 
+def archiver():
+    # Background thread, archive finished logfiles every archiveInterval
+    ## ConsoleArchive lives in console-archive.py, only loaded when archiving
+    archive = load_script('consolearchive', 'console-archive.py').ConsoleArchive(
+        archiveFolder, bootMsg, archiveChunk)
+    while True:
+        archive.run(consoleLogFolder, logFilePrefix, archiveAge)
+        sleep(archiveInterval)
+
+
+def start_archiver():
+    t = threading.Thread(target=archiver, name='console-archiver')
+    t.daemon = True
+    t.start()
+    return t
+
+
+def start_serial():
+    # Talk to the console port directly, it writes the logfile itself
+    global serialConsole
+    device = serialDevice
+    if device == 'pty': device = FakeConsole().start()
+    serialConsole = SerialConsole(device, serialBaud, consoleLogFolder, logFilePrefix).start()
+    return serialConsole
+
+
 def main():
     # Main Function
     global logging, consoleLogFolder, rootfolder
 
     logging.debug('rootfolder=%s -- consoleLogFolder=%s',rootfolder,consoleLogFolder)
+    if consoleMode == 'serial': start_serial()
+    if archiveFolder is not None: start_archiver()
     ## Constantly watch the screen log file
     while True:
         ## Find the current logfile
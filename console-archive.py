@@ -0,0 +1,265 @@
+#-------------------------------------------------------------------------------
+# Name:        Console-Archive.py
+# Purpose:      Archive HP501 console logs and search them by time or boot
+#
+# Created:     Oct 18, 2026
+#
+# Updated:
+#-------------------------------------------------------------------------------
+#!/usr/bin/env python
+
+# ConsoleArchive keeps finished console logfiles as indexed gzip chunks.
+# RasPi-501-Console.py loads this file and archives finished logfiles
+# itself when archiveFolder is set, 'archive' does the same once, e.g. for
+# logs from before it was enabled. Searches only inflate the chunks the
+# index points at.
+#
+# Usage: console-archive.py archive --archive ~/console_archive [--age 0]
+#        console-archive.py boots --archive ~/console_archive
+#        console-archive.py show --archive ~/console_archive --boot 12
+#        console-archive.py show --archive ~/console_archive \
+#                           --start '2026-10-01 10:00' --end '2026-10-01 12:00' --grep 'ERR'
+#
+# Times are UTC like the ykDebug timestamps: epoch seconds or
+# 'YYYY-MM-DD[ HH:MM[:SS]]'.
+
+from os import path, makedirs
+from time import time
+from datetime import datetime
+import os, sys, argparse, fcntl, logging, re, calendar, sqlite3, zlib
+from debugtime import parse_debug_time
+
+# Defaults for the command line, the watchdog passes its own settings
+rootfolder = path.expanduser('~')
+consoleLogFolder = path.join(rootfolder,'console_logs')
+logFilePrefix = 'HP501_ttyUSB0.'
+bootMsg = 'Boot Successful - Config Ok'
+archiveAge = 3600       # seconds without writes before a logfile counts as finished
+archiveChunk = 65536    # bytes of log per gzip member, the unit a search reads back
+
+
+class ConsoleArchive(object):
+    # Compressed logfiles and their index in folder
+    # Each finished logfile becomes name-mtime.gz made of independent gzip
+    # members of about archiveChunk bytes, so zcat still reads the whole file
+    # while a search seeks to one member and inflates only that.
+    # archive.db keeps per chunk the byte offsets and the first/last debug
+    # timestamp, and every boot message. A boot always starts a new chunk.
+    # run() holds archive.lock so the watchdog thread and this script never
+    # archive the same logfile twice.
+
+    schema = [
+        'CREATE TABLE IF NOT EXISTS files (id INTEGER PRIMARY KEY, name TEXT, archive TEXT, '
+        'mtime REAL, size INTEGER)',
+        'CREATE TABLE IF NOT EXISTS chunks (file INTEGER, chunk INTEGER, offset INTEGER, '
+        'length INTEGER, raw_offset INTEGER, raw_length INTEGER, first_ts INTEGER, last_ts INTEGER, '
+        'PRIMARY KEY (file, chunk))',
+        'CREATE INDEX IF NOT EXISTS chunks_ts ON chunks (last_ts)',
+        'CREATE TABLE IF NOT EXISTS boots (id INTEGER PRIMARY KEY, file INTEGER, chunk INTEGER, '
+        'before_ts INTEGER)',
+        ]
+
+    def __init__(self, folder, bootmsg=bootMsg, chunksize=archiveChunk):
+        self.folder = folder
+        self.bootmsg = bootmsg
+        self.chunksize = chunksize
+        if not path.isdir(folder): makedirs(folder)
+        self.db = sqlite3.connect(path.join(folder, 'archive.db'))
+        for sql in self.schema:
+            self.db.execute(sql)
+        self.db.commit()
+
+    def finished(self, logfolder, prefix, age):
+        # Logfiles not written for age seconds, oldest first
+        # The newest file is never finished, screen may still be writing it
+        files = []
+        for name in os.listdir(logfolder):
+            if not name.startswith(prefix): continue
+            filename = path.join(logfolder, name)
+            if path.isfile(filename): files.append((os.stat(filename).st_mtime, filename))
+        files.sort()
+        return [f for mtime, f in files[:-1] if time() - mtime >= age]
+
+    def write_chunk(self, dst, data):
+        ## One gzip member, returns its (offset, length)
+        offset = dst.tell()
+        c = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        dst.write(c.compress(data) + c.flush())
+        return offset, dst.tell() - offset
+
+    def add(self, filename, chunksize=None):
+        # Compress and index filename, then remove it
+        if chunksize is None: chunksize = self.chunksize
+        st = os.stat(filename)
+        name = path.basename(filename)
+        archive = '%s-%d.gz' %(name, st.st_mtime)
+        tmp = path.join(self.folder, archive + '.tmp')
+        chunks = []
+        boots = []
+        with open(filename, 'rb') as src:
+            with open(tmp, 'wb') as dst:
+                buf = []
+                size = raw = 0
+                first = last = ts = None
+                for line in src:
+                    text = line.decode('utf-8', 'replace').strip()
+                    boot = self.bootmsg in text
+                    if size and (boot or size >= chunksize):
+                        chunks.append(self.write_chunk(dst, b''.join(buf)) + (raw, size, first, last))
+                        raw += size
+                        buf = []
+                        size = 0
+                        first = last = None
+                    if boot: boots.append((len(chunks), ts))
+                    t = parse_debug_time(text)
+                    if t is not None:
+                        ts = last = t
+                        if first is None: first = t
+                    buf.append(line)
+                    size += len(line)
+                if size:
+                    chunks.append(self.write_chunk(dst, b''.join(buf)) + (raw, size, first, last))
+                dst.flush()
+                os.fsync(dst.fileno())
+        os.rename(tmp, path.join(self.folder, archive))
+
+        with self.db:
+            cur = self.db.execute('INSERT INTO files (name, archive, mtime, size) VALUES (?,?,?,?)',
+                                  (name, archive, st.st_mtime, st.st_size))
+            fid = cur.lastrowid
+            self.db.executemany('INSERT INTO chunks VALUES (?,?,?,?,?,?,?,?)',
+                                [(fid, i) + c for i, c in enumerate(chunks)])
+            self.db.executemany('INSERT INTO boots (file, chunk, before_ts) VALUES (?,?,?)',
+                                [(fid,) + b for b in boots])
+        os.remove(filename)
+        logging.info('Archived %s: %d bytes in %d chunks, %d boots',name,st.st_size,len(chunks),len(boots))
+        return archive
+
+    def run(self, logfolder, prefix, age):
+        # Archive every finished logfile, returns how many were done
+        ## Waits for another process archiving into the same folder
+        done = 0
+        with open(path.join(self.folder, 'archive.lock'), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                for filename in self.finished(logfolder, prefix, age):
+                    try:
+                        self.add(filename)
+                        done += 1
+                    except (IOError, OSError, sqlite3.Error) as e:
+                        logging.warn('Archive Error %s: %s',filename,e)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+        return done
+
+    def chunks(self, start=None, end=None, boot=None):
+        # (archive, chunk row) in log order for a time range or a boot cycle
+        # A time range covers from the first chunk ending after start to
+        # the last chunk beginning before end, chunks without timestamps
+        # in between are included
+        sql = ('SELECT f.archive, c.file, c.chunk, c.offset, c.length, c.first_ts, c.last_ts '
+               'FROM chunks c JOIN files f ON f.id = c.file WHERE (c.file, c.chunk) >= (?, ?) '
+               'AND (c.file, c.chunk) < (?, ?) ORDER BY c.file, c.chunk')
+        lo = (0, 0)
+        hi = (1 << 62, 0)
+        if boot is not None:
+            rows = self.db.execute('SELECT file, chunk FROM boots WHERE id >= ? ORDER BY id LIMIT 2',
+                                   (boot,)).fetchall()
+            if not rows: return []
+            lo = rows[0]
+            if len(rows) > 1: hi = rows[1]
+        if start is not None:
+            row = self.db.execute('SELECT file, chunk FROM chunks WHERE last_ts >= ? '
+                                  'ORDER BY file, chunk LIMIT 1', (start,)).fetchone()
+            if row is None: return []
+            lo = max(lo, row)
+        if end is not None:
+            row = self.db.execute('SELECT file, chunk FROM chunks WHERE first_ts <= ? '
+                                  'ORDER BY file DESC, chunk DESC LIMIT 1', (end,)).fetchone()
+            if row is None: return []
+            hi = min(hi, (row[0], row[1] + 1))
+        return self.db.execute(sql, lo + hi).fetchall()
+
+    def read(self, archive, offset, length):
+        # Inflate one chunk
+        with open(path.join(self.folder, archive), 'rb') as f:
+            f.seek(offset)
+            return zlib.decompress(f.read(length), 16 + zlib.MAX_WBITS)
+
+    def boots(self):
+        # (boot id, logfile name, last timestamp before, first timestamp after)
+        return self.db.execute(
+            'SELECT b.id, f.name, b.before_ts, '
+            '(SELECT first_ts FROM chunks c WHERE (c.file, c.chunk) >= (b.file, b.chunk) '
+            'AND first_ts IS NOT NULL ORDER BY c.file, c.chunk LIMIT 1) '
+            'FROM boots b JOIN files f ON f.id = b.file ORDER BY b.id').fetchall()
+
+    def close(self):
+        self.db.close()
+
+
+def parse_time(value):
+    # Epoch seconds or a UTC date/time string
+    value = value.strip()
+    if value.isdigit():
+        return int(value)
+    for fmt in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d'):
+        try:
+            return calendar.timegm(datetime.strptime(value, fmt).timetuple())
+        except ValueError:
+            pass
+    raise argparse.ArgumentTypeError('Unknown time: %s' %value)
+
+
+def show_time(ts):
+    if ts is None: return '-'
+    return datetime.utcfromtimestamp(ts).strftime('%Y-%m-%d %H:%M:%S')
+
+
+def lines(archive, rows, start=None, end=None):
+    # Yield the log lines of rows, trimmed to [start, end] by the debug
+    # timestamps seen on the way
+    ts = None
+    for name, fid, chunk, offset, length, first, last in rows:
+        for line in archive.read(name, offset, length).decode('utf-8', 'replace').splitlines(True):
+            t = parse_debug_time(line.strip())
+            if t is not None: ts = t
+            if start is not None and (ts is None or ts < start): continue
+            if end is not None and ts is not None and ts > end: return
+            yield line
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Archive and search HP501 console logs')
+    parser.add_argument('command', choices=['archive', 'boots', 'show'])
+    parser.add_argument('--archive', required=True, help='archive folder, archiveFolder in RasPi-501-Console.py')
+    parser.add_argument('--logs', default=consoleLogFolder, help='logfile folder')
+    parser.add_argument('--prefix', default=logFilePrefix, help='logfile name prefix')
+    parser.add_argument('--age', type=int, default=archiveAge, help='seconds without writes before a logfile is archived')
+    parser.add_argument('--start', type=parse_time)
+    parser.add_argument('--end', type=parse_time)
+    parser.add_argument('--boot', type=int, help='show one boot cycle, see boots')
+    parser.add_argument('--grep', help='only lines matching this regex')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    archive = ConsoleArchive(path.expanduser(args.archive))
+    try:
+        if args.command == 'archive':
+            done = archive.run(path.expanduser(args.logs), args.prefix, args.age)
+            sys.stdout.write('Archived %d logfiles\n' %done)
+        elif args.command == 'boots':
+            for boot, name, before, after in archive.boots():
+                sys.stdout.write('%6d  %s  %s  %s\n' %(boot, show_time(before), show_time(after), name))
+        else:
+            rows = archive.chunks(args.start, args.end, args.boot)
+            match = re.compile(args.grep) if args.grep else None
+            for line in lines(archive, rows, args.start, args.end):
+                if match is None or match.search(line):
+                    sys.stdout.write(line)
+    finally:
+        archive.close()
+
+
+if __name__ == '__main__':
+    main()
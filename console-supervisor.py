@@ -0,0 +1,234 @@
+#-------------------------------------------------------------------------------
+# Name:        Console-Supervisor.py
+# Purpose:      Watch many HP501 consoles from one process
+#
+# Created:     Oct 18, 2026
+#
+# Updated:
+#-------------------------------------------------------------------------------
+#!/usr/bin/env python3
+
+# Runs the RasPi-501-Console.py watchdog for every console in a JSON config
+# file on one asyncio loop (Python 3 only).
+#
+# Each console gets its own copy of RasPi-501-Console.py, so its session,
+# credentials, prompt rules, login state and log folder never mix with
+# another console. Every key of a console entry sets the global of the
+# same name in its copy, e.g.
+#
+#   {"logfile": "console-supervisor.log",
+#    "consoles": [
+#      {"name": "rack1", "sessionID": "HP501", "logFilePrefix": "HP501_ttyUSB0.",
+#       "consoleLogFolder": "~/console_logs/rack1", "synctime": true},
+#      {"name": "rack2", "consoleMode": "serial", "serialDevice": "/dev/ttyUSB1",
+#       "logFilePrefix": "HP501_ttyUSB1.", "consoleLogFolder": "~/console_logs/rack2",
+#       "username": "admin", "password": "secret"}
+#    ]}
+#
+# Isolation: keys are sent by a sender task per console with a deadline,
+# screen runs as a subprocess and serial writes run in the executor, so a
+# wedged screen session or serial port only delays its own console, and
+# pauses between keys are awaited by the sender, not the loop. An
+# error in one console is logged and that console restarts after
+# restartDelay, the others keep going. Only consoles with "synctime" set
+# the system clock, in the executor. Events go to the shared event store
+# from a worker thread, with the console name as the device.
+#
+# Usage: console-supervisor.py [config.json]
+
+from os import path
+from time import time
+from concurrent.futures import ThreadPoolExecutor
+import sys, json, asyncio, contextvars, logging
+from loadscript import load_script
+
+configFile = path.join(path.expanduser('~'), 'console-supervisor.json')
+sendTimeout = 5     # seconds a single screen or serial send may take
+sendQueue = 32      # keys waiting per console before new ones are dropped
+restartDelay = 10   # seconds before a failed console is started again
+lineBatch = 200     # lines handled before letting the other consoles run
+current = contextvars.ContextVar('console', default='-')
+
+
+class ConsoleFilter(logging.Filter):
+    # Tag log records with the console whose task is running
+    def filter(self, record):
+        record.console = current.get()
+        return True
+
+
+def load_console(name):
+    # A private copy of the watchdog module for one console
+    return load_script('console_%s' %name, 'RasPi-501-Console.py')
+
+
+class Console(object):
+    # One console: its module copy, sender task and follower task
+
+    def __init__(self, config):
+        self.config = dict(config)
+        self.name = self.config.pop('name')
+        self.synctime = self.config.pop('synctime', False)
+        self.mod = load_console(self.name)
+        self.mod.stateFile = path.join(self.mod.rootfolder, 'console-state-%s.json' %self.name)
+        for key, value in self.config.items():
+            if not hasattr(self.mod, key):
+                raise ValueError('Unknown setting %s for console %s' %(key, self.name))
+            if isinstance(value, str) and value.startswith('~'):
+                value = path.expanduser(value)
+            setattr(self.mod, key, value)
+        ## Sends and clock syncs must not block the loop
+        self.mod.send_screen_cmd = self.send
+        self.mod.send_pause = self.pause
+        self.syncRemoteTime = self.mod.syncRemoteTime
+        self.mod.syncRemoteTime = self.sync
+        ## Events are tagged with the console name, inserts run off the loop
+        self.events = self.mod.eventstore.EventStore(self.mod.eventFile, 'console', self.name)
+        self.publisher = ThreadPoolExecutor(1)
+        self.mod.publish = self.publish
+        self.queue = None
+        self.loop = None
+
+    def send(self, value, delay=0):
+        ## Called by the handlers, queue the keys for the sender task
+        try:
+            self.queue.put_nowait((value, delay))
+        except asyncio.QueueFull:
+            logging.warning('Send queue full, dropped [%s]',value)
+            return False
+        return True
+
+    def pause(self, seconds):
+        ## The sender waits before the next keys, the loop keeps running
+        self.send(None, seconds)
+
+    def publish(self, kind, **kw):
+        ## Called from the loop and from clock syncs in the executor, one
+        ## worker keeps the events in order, ts is when it happened
+        if self.events.filename is None: return False
+        kw.setdefault('ts', time() * 1000)
+        self.publisher.submit(self.events.publish, kind, **kw)
+        return True
+
+    def sync(self, line):
+        if self.synctime:
+            self.loop.run_in_executor(None, self.syncRemoteTime, line)
+
+    async def sender(self):
+        current.set(self.name)
+        mod = self.mod
+        while True:
+            value, delay = await self.queue.get()
+            if delay:
+                await asyncio.sleep(delay)
+            if value is None:
+                continue
+            try:
+                if mod.serialConsole is not None:
+                    ok = await asyncio.wait_for(
+                        self.loop.run_in_executor(None, mod.serialConsole.send, value), sendTimeout)
+                else:
+                    ## Same as send_screen_cmd() without a shell
+                    proc = await asyncio.create_subprocess_exec(
+                        'screen', '-S', mod.sessionID, '-X', 'stuff', '%s^M' %value)
+                    try:
+                        ok = await asyncio.wait_for(proc.wait(), sendTimeout) == 0
+                    except asyncio.TimeoutError:
+                        proc.kill()
+                        raise
+                logging.debug('sent [%s] ok=%s',value,ok)
+            except asyncio.TimeoutError:
+                logging.warning('Send timed out after %ds [%s]',sendTimeout,value)
+            except OSError as e:
+                logging.warning('Send Error: %s',e)
+
+    async def follow(self):
+        # follow() and consume_lines() without blocking the loop
+        mod = self.mod
+        conFile = mod.newLog(mod.consoleLogFolder)
+        if not conFile:
+            raise IOError('No logfile in %s' %mod.consoleLogFolder)
+        logging.info('Monitoring Console Logfile: %s',conFile)
+        follower = mod.LogFollower(open(conFile, 'r'))
+        watch = mod.LogWatch(follower.folder)
+        wake = asyncio.Event()
+        if watch.inotify is not None:
+            self.loop.add_reader(watch.inotify.fd, wake.set)
+        try:
+            while True:
+                lines = follower.lines(lineBatch)
+                ## The empty line checks the login deadlines
+                mod.consume_lines(lines + [''])
+                if len(lines) == lineBatch:
+                    await asyncio.sleep(0)
+                    continue
+                wait = follower.idle()
+                if watch.inotify is None:
+                    await asyncio.sleep(min(wait, mod.pollInterval))
+                    events = None
+                else:
+                    try:
+                        await asyncio.wait_for(wake.wait(), wait)
+                    except asyncio.TimeoutError:
+                        pass
+                    wake.clear()
+                    events = [(mask, name) for wd, mask, name in watch.inotify.read(0)]
+                follower.events(events)
+        finally:
+            if watch.inotify is not None:
+                self.loop.remove_reader(watch.inotify.fd)
+            watch.close()
+            follower.close()
+
+    async def run(self):
+        current.set(self.name)
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue(sendQueue)
+        sender = asyncio.ensure_future(self.sender())
+        try:
+            if self.mod.consoleMode == 'serial': self.mod.start_serial()
+            while True:
+                try:
+                    await self.follow()
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    logging.exception('Console failed, restarting in %ds: %s',restartDelay,e)
+                    await asyncio.sleep(restartDelay)
+        finally:
+            sender.cancel()
+            if self.mod.serialConsole is not None: self.mod.serialConsole.close()
+            self.publisher.shutdown()
+            self.events.close()
+
+
+async def supervise(consoles):
+    await asyncio.gather(*[c.run() for c in consoles])
+
+
+def main():
+    filename = sys.argv[1] if len(sys.argv) > 1 else configFile
+    with open(filename) as f:
+        config = json.load(f)
+
+    ## Configure logging before the console copies call basicConfig
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s %(levelname)-8s [%(console)s] %(message)s',
+                        filename=config.get('logfile', 'console-supervisor.log'),
+                        filemode='a')
+    for handler in logging.getLogger().handlers:
+        handler.addFilter(ConsoleFilter())
+
+    consoles = [Console(c) for c in config['consoles']]
+    names = [c.name for c in consoles]
+    if len(set(names)) != len(names):
+        raise ValueError('Console names must be unique: %s' %names)
+    logging.info('Started Console Supervisor for %s',', '.join(names))
+    try:
+        asyncio.run(supervise(consoles))
+    except KeyboardInterrupt:
+        logging.info('User interupt - Quitting Supervisor')
+
+
+if __name__ == '__main__':
+    main()
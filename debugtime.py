@@ -0,0 +1,46 @@
+#-------------------------------------------------------------------------------
+# Name:        DebugTime.py
+# Purpose:      Parse the ykDebug timestamps in HP501 console logs
+#
+# Created:     Oct 18, 2026
+#
+# Updated:
+#-------------------------------------------------------------------------------
+#!/usr/bin/env python
+
+# Shared by the console watchdog, for clock sync, and console-archive.py,
+# for the archive index. A timestamp line looks like
+#   ****** 10/18/26 10:00:01 UTC ******
+
+from time import mktime, tzname
+from datetime import datetime
+import re, calendar
+
+debugstamp = re.compile(r"^\*+\s+(\d\d/\d\d/\d\d) (\d\d):(\d\d):(\d\d) (\w+)")  # Fields of a debug timestamp
+dayCache = {}
+utcZones = ('UTC', 'GMT')
+
+
+def parse_debug_time(line):
+    # Epoch seconds of a "****** MM/DD/YY HH:MM:SS UTC ******" line, or None
+    # UTC/GMT stamps are epoch via timegm, the local zone via mktime,
+    # a stamp in any other zone is skipped
+    # Only the date goes through strptime, once per day
+    m = debugstamp.match(line)
+    if m is None: return None
+    zone = m.group(5)
+    if zone not in utcZones and zone not in tzname: return None
+    day = dayCache.get(m.group(1))
+    if day is None:
+        try:
+            date = datetime.strptime(m.group(1), '%m/%d/%y').timetuple()
+        except ValueError:
+            return None
+        day = (date, calendar.timegm(date))
+        if len(dayCache) > 64: dayCache.clear()
+        dayCache[m.group(1)] = day
+    hour, minute, sec = int(m.group(2)), int(m.group(3)), int(m.group(4))
+    if zone in utcZones:
+        return day[1] + hour * 3600 + minute * 60 + sec
+    ## mktime works out the DST offset for that time of day
+    return int(mktime(day[0][:3] + (hour, minute, sec, 0, 0, -1)))
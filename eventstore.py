@@ -0,0 +1,189 @@
+#-------------------------------------------------------------------------------
+# Name:        EventStore.py
+# Purpose:      Shared event log for power-monitor and the console watchdog
+#
+# Created:     Oct 18, 2026
+#
+# Updated:
+#-------------------------------------------------------------------------------
+#!/usr/bin/env python
+
+# Both daemons publish timestamped events into one SQLite file:
+#   power-monitor.py      excursion, calibration, recalibrate, clockstep
+#   RasPi-501-Console.py  boot, login, debug, stuck, clock
+# Events are rare so every publish is its own short transaction, the file
+# is in WAL mode so readers never block the daemons.
+#
+# Run as a script it queries the store, correlate lists every power
+# anomaly with the console events within --window of it and the boot
+# cycle it happened in.
+#
+# Usage: eventstore.py events --start=-1d [--kind boot]
+#        eventstore.py correlate --start=-7d --window 300
+#
+# Times are epoch ms, 'YYYY-MM-DD[ HH:MM[:SS]]' local time, or relative to
+# now like -30m, -12h, -7d.
+
+from __future__ import division
+from os import path
+from datetime import datetime
+from time import mktime, time
+import sys, argparse, csv, json, logging, sqlite3, threading
+
+eventfile = '/home/admin/db/events.db'    # Default store for both daemons
+units = {'s': 1000, 'm': 60000, 'h': 3600000, 'd': 86400000}
+fields = ('id', 'ts', 'source', 'device', 'kind', 'value', 'duration', 'detail')
+# Power events that count as anomalies for correlate
+anomalies = ('excursion', 'recalibrate', 'clockstep')
+
+logger = logging.getLogger('eventstore')
+
+schema = [
+    'CREATE TABLE IF NOT EXISTS events (id INTEGER PRIMARY KEY, ts INTEGER, source TEXT, '
+    'device TEXT, kind TEXT, value REAL, duration INTEGER, detail TEXT)',
+    'CREATE INDEX IF NOT EXISTS events_ts ON events (ts)',
+    'CREATE INDEX IF NOT EXISTS events_kind ON events (kind, ts)',
+    ]
+
+
+class EventStore(object):
+    # Publisher for one daemon, source is 'power' or 'console'
+    # The file is opened by the first event, so a daemon can create its
+    # store at import, filename None drops every event
+    # publish() can be called from any thread and never raises, a locked
+    # or broken store only costs a log line
+
+    def __init__(self, filename, source, device=None, timeout=1.0):
+        self.filename = filename
+        self.source = source
+        self.device = device
+        self.timeout = timeout
+        self.conn = None
+        self.lock = threading.Lock()
+
+    def open(self):
+        conn = sqlite3.connect(self.filename, timeout=self.timeout, check_same_thread=False)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        for sql in schema:
+            conn.execute(sql)
+        conn.commit()
+        self.conn = conn
+        return self
+
+    def publish(self, kind, ts=None, value=None, duration=None, detail=None):
+        # ts and duration in ms, ts defaults to now, detail is stored as JSON
+        if self.filename is None: return False
+        if ts is None: ts = time() * 1000
+        if detail is not None: detail = json.dumps(detail, sort_keys=True)
+        with self.lock:
+            try:
+                if self.conn is None: self.open()
+                with self.conn:
+                    self.conn.execute('INSERT INTO events (ts, source, device, kind, value, duration, detail) '
+                                      'VALUES (?,?,?,?,?,?,?)',
+                                      (int(ts), self.source, self.device, kind, value,
+                                       None if duration is None else int(duration), detail))
+                return True
+            except sqlite3.Error as e:
+                logger.warning('Could not publish %s event to %s: %s', kind, self.filename, e)
+                return False
+
+    def close(self):
+        with self.lock:
+            if self.conn is not None: self.conn.close()
+            self.conn = None
+
+
+def connect(filename):
+    # Reader connection, never writes to the store
+    if not path.exists(filename):
+        raise IOError('No event store at %s' %filename)
+    conn = sqlite3.connect(filename)
+    conn.execute('PRAGMA query_only=1')
+    return conn
+
+
+def events(conn, start, end, kinds=None):
+    # Events in [start, end), oldest first
+    sql = 'SELECT %s FROM events WHERE ts >= ? AND ts < ?' %', '.join(fields)
+    args = [int(start), int(end)]
+    if kinds:
+        sql += ' AND kind IN (%s)' %','.join('?' * len(kinds))
+        args += list(kinds)
+    return conn.execute(sql + ' ORDER BY ts, id', args)
+
+
+def correlate(conn, start, end, window, kinds=anomalies):
+    # One row per power anomaly and console event within window ms of it,
+    # anomalies without a console event nearby get one row with NULLs
+    # Each row: anomaly ts, kind, value, duration, console device, ts of
+    # the boot that started the cycle the anomaly is in (on that device),
+    # console event ts, kind, seconds from the anomaly to the console event
+    sql = ('SELECT a.ts, a.kind, a.value, a.duration, c.device, '
+           '(SELECT MAX(b.ts) FROM events b WHERE b.kind = \'boot\' AND b.ts <= a.ts '
+           ' AND (c.device IS NULL OR b.device = c.device)), '
+           'c.ts, c.kind, (c.ts - a.ts) / 1000.0 '
+           'FROM events a LEFT JOIN events c ON c.source = \'console\' '
+           ' AND c.ts >= a.ts - :window AND c.ts <= a.ts + COALESCE(a.duration, 0) + :window '
+           'WHERE a.source = \'power\' AND a.kind IN (%s) AND a.ts >= :start AND a.ts < :end '
+           'ORDER BY a.ts, a.id, c.ts') %','.join(':k%d' %i for i in range(len(kinds)))
+    args = {'window': int(window), 'start': int(start), 'end': int(end)}
+    for i, k in enumerate(kinds):
+        args['k%d' %i] = k
+    return conn.execute(sql, args)
+
+
+def parse_time(value, now=None):
+    # Epoch ms, relative to now (-7d) or a local date/time string
+    if now is None: now = time()
+    value = value.strip()
+    if value == 'now':
+        return int(now * 1000)
+    if value.startswith('-') and value[-1] in units:
+        return int(now * 1000 - float(value[1:-1]) * units[value[-1]])
+    if value.isdigit():
+        return int(value)
+    for fmt in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d'):
+        try:
+            return int(mktime(datetime.strptime(value, fmt).timetuple()) * 1000)
+        except ValueError:
+            pass
+    raise argparse.ArgumentTypeError('Unknown time: %s' %value)
+
+
+def show_time(ts):
+    if ts is None: return ''
+    return datetime.fromtimestamp(ts / 1000).strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Query the shared power and console event store')
+    parser.add_argument('command', choices=['events', 'correlate'])
+    parser.add_argument('--db', default=eventfile)
+    parser.add_argument('--start', type=parse_time, default='-1d')
+    parser.add_argument('--end', type=parse_time, default='now')
+    parser.add_argument('--kind', action='append', help='event kinds, repeat for more')
+    parser.add_argument('--window', type=float, default=300, help='seconds around an anomaly for correlate')
+    args = parser.parse_args()
+
+    conn = connect(args.db)
+    out = csv.writer(sys.stdout)
+    try:
+        if args.command == 'events':
+            out.writerow(fields)
+            for row in events(conn, args.start, args.end, args.kind):
+                out.writerow((row[0], show_time(row[1])) + tuple(row[2:]))
+        else:
+            out.writerow(('time', 'kind', 'value', 'duration_ms', 'device', 'boot',
+                          'console_time', 'console_kind', 'delta_s'))
+            rows = correlate(conn, args.start, args.end, args.window * 1000, args.kind or anomalies)
+            for ts, kind, value, duration, device, boot, cts, ckind, delta in rows:
+                out.writerow((show_time(ts), kind, value, duration, device, show_time(boot),
+                              show_time(cts), ckind, delta))
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,32 @@
+#-------------------------------------------------------------------------------
+# Name:        LoadScript.py
+# Purpose:      Load the hyphenated scripts of this folder as modules
+#
+# Created:     Oct 18, 2026
+#
+# Updated:
+#-------------------------------------------------------------------------------
+#!/usr/bin/env python
+
+# power-monitor.py, console-archive.py and RasPi-501-Console.py can't be
+# imported by name. power-query.py, power-bench.py, the watchdog and the
+# supervisor load them by path with load_script(), through importlib where
+# it is there and imp on Python 2.
+
+from os import path
+
+here = path.dirname(path.abspath(__file__))
+
+
+def load_script(name, filename):
+    # A fresh module called name from filename next to this file
+    filename = path.join(here, filename)
+    try:
+        import importlib.util
+    except ImportError:
+        import imp
+        return imp.load_source(name, filename)
+    spec = importlib.util.spec_from_file_location(name, filename)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
@@ -0,0 +1,220 @@
+#-------------------------------------------------------------------------------
+# Name:        Power-Bench.py
+# Purpose:      Benchmark the Power-Monitor sample pipeline with synthetic data
+#
+# Created:     Oct 18, 2026
+#
+# Updated:
+#-------------------------------------------------------------------------------
+#!/usr/bin/env python
+
+# Drives read_adc -> convert_raw_block -> stats -> storeData from
+# power-monitor.py with SyntheticADC samples for every combination of
+# rate, blocksize and ssize, then reports:
+#   throughput     samples per second actually processed
+#   latency        p50/p90/p99/max per stage in ms (read per sample,
+#                  convert/stats/store per block)
+#   write amp      bytes written by the process / logical bytes stored
+# Results are saved as JSON, --compare prints the change against an
+# older result file.
+#
+# Usage: power-bench.py [--samples N] [--rates 0,43,860] [--blocksizes 100]
+#                       [--ssizes 1000] [--combined]
+#                       [--output bench.json] [--compare old.json]
+
+from __future__ import division
+from os import path
+from time import sleep, time
+import sys, argparse, json, platform, tempfile, shutil, numpy
+from loadscript import load_script
+
+
+def io_written():
+    # Bytes passed to write() by this process, 0 when /proc is not available
+    try:
+        with open('/proc/self/io') as f:
+            for line in f:
+                if line.startswith('wchar:'):
+                    return int(line.split()[1])
+    except IOError:
+        pass
+    return 0
+
+
+def db_bytes(dbfile):
+    # Size of the database including the WAL
+    total = 0
+    for f in (dbfile, dbfile + '-wal'):
+        if path.exists(f): total += path.getsize(f)
+    return total
+
+
+def percentiles(values):
+    # Latency summary in ms
+    if not len(values):
+        return {}
+    a = numpy.asarray(values) * 1000
+    return {'p50': float(numpy.percentile(a, 50)),
+            'p90': float(numpy.percentile(a, 90)),
+            'p99': float(numpy.percentile(a, 99)),
+            'max': float(a.max()),
+            'count': len(a)}
+
+
+def run(pm, samples, rate, blocksize, ssize, workdir):
+    # Run one configuration and return its results
+    dbfile = path.join(workdir, 'bench-%d-%d-%d.db' %(rate, blocksize, ssize))
+    pm.dbfile = dbfile
+    # Create the schema before measuring
+    pm.dbwriter = pm.DBWriter(dbfile, pm.commitrows, pm.commitinterval).open()
+    pm.blocksize = blocksize
+    pm.ssize = ssize
+    pm.reset_stats()
+
+    # Time storeData() separately from the rest of stats()
+    storetimes = []
+    storeData = pm.storeData
+    def timedStore(block):
+        t = time()
+        r = storeData(block)
+        storetimes.append(time() - t)
+        return r
+    pm.storeData = timedStore
+
+    readtimes = []
+    converttimes = []
+    statstimes = []
+    rows = 0
+
+    readings = pm.read_adc(pm.SyntheticADC(realtime=False))
+    rawblock = numpy.empty((blocksize, 5), dtype=numpy.float64)
+    c = 0
+    w0 = io_written()
+    d0 = db_bytes(dbfile)
+    start = time()
+    try:
+        for n in range(samples):
+            if rate:
+                # Offer samples at a fixed rate, catch up when behind
+                wait = start + n/rate - time()
+                if wait > 0: sleep(wait)
+            t = time()
+            vlist = next(readings)
+            readtimes.append(time() - t)
+            rawblock[c] = vlist[:5]
+            c += 1
+            if c == blocksize:
+                t = time()
+                datablock = pm.convert_raw_block(rawblock)
+                t1 = time()
+                nstore = len(storetimes)
+                pm.stats(datablock)
+                t2 = time()
+                converttimes.append(t1 - t)
+                statstimes.append(t2 - t1 - sum(storetimes[nstore:]))
+                rows += 1 if pm.combinedtable else 2
+                c = 0
+        # Flush the last transaction inside the measurement
+        if pm.dbwriter is not None: pm.dbwriter.close()
+    finally:
+        pm.storeData = storeData
+    elapsed = time() - start
+
+    # Logical payload: 8 bytes per stored column
+    ncols = len(pm.columns('power' if pm.combinedtable else 'voltage'))
+    logical = rows * ncols * 8
+    written = io_written() - w0
+    return {
+        'rate': rate,
+        'blocksize': blocksize,
+        'ssize': ssize,
+        'combined': pm.combinedtable,
+        'samples': samples,
+        'elapsed': elapsed,
+        'throughput': samples / elapsed,
+        'kept_up': (not rate) or samples / elapsed >= rate * 0.99,
+        'latency_ms': {
+            'read': percentiles(readtimes),
+            'convert': percentiles(converttimes),
+            'stats': percentiles(statstimes),
+            'store': percentiles(storetimes),
+            },
+        'db': {
+            'rows': rows,
+            'logical_bytes': logical,
+            'file_bytes': db_bytes(dbfile) - d0,
+            'written_bytes': written,
+            'write_amplification': written / logical if logical else 0,
+            },
+        }
+
+
+def key(r):
+    return (r['rate'], r['blocksize'], r['ssize'])
+
+
+def report(results, baseline=None):
+    # Print a summary table, with the change against baseline when given
+    old = {}
+    if baseline is not None:
+        old = dict((key(r), r) for r in baseline['results'])
+    sys.stdout.write('%6s %6s %6s %10s %8s %9s %9s %9s %7s\n' %(
+        'rate', 'block', 'ssize', 'samples/s', 'change', 'stats p99', 'store p99', 'store max', 'wamp'))
+    for r in results:
+        change = ''
+        if key(r) in old:
+            change = '%+.1f%%' %((r['throughput'] / old[key(r)]['throughput'] - 1) * 100)
+        lat = r['latency_ms']
+        sys.stdout.write('%6s %6d %6d %10.1f %8s %9.3f %9.3f %9.3f %7.1f\n' %(
+            r['rate'] or 'max', r['blocksize'], r['ssize'], r['throughput'], change,
+            lat['stats'].get('p99', 0), lat['store'].get('p99', 0),
+            lat['store'].get('max', 0), r['db']['write_amplification']))
+
+
+def intlist(value):
+    return [int(v) for v in value.split(',') if v]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the power-monitor sample pipeline')
+    parser.add_argument('--samples', type=int, default=20000, help='samples per run')
+    parser.add_argument('--rates', type=intlist, default=[0], help='offered samples/s, 0 = as fast as possible')
+    parser.add_argument('--blocksizes', type=intlist, default=[50, 100, 500])
+    parser.add_argument('--ssizes', type=intlist, default=[1000])
+    parser.add_argument('--combined', action='store_true', help='store blocks in the combined power table')
+    parser.add_argument('--output', help='save results as JSON')
+    parser.add_argument('--compare', help='JSON results from an earlier run')
+    args = parser.parse_args()
+
+    pm = load_script('power_monitor', 'power-monitor.py')
+    pm.combinedtable = args.combined
+    # Keep benchmark excursions and calibration out of the shared files
+    pm.eventfile = None
+    pm.calfile = None
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    workdir = tempfile.mkdtemp(prefix='power-bench-')
+    results = []
+    try:
+        for rate in args.rates:
+            for blocksize in args.blocksizes:
+                for ssize in args.ssizes:
+                    results.append(run(pm, args.samples, rate, blocksize, ssize, workdir))
+    finally:
+        shutil.rmtree(workdir)
+
+    report(results, baseline)
+    if args.output:
+        out = {'created': time(),
+               'python': platform.python_version(),
+               'platform': platform.platform(),
+               'results': results}
+        with open(args.output, 'w') as f:
+            json.dump(out, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -11,10 +11,34 @@
 #!/usr/bin/env python
 
 from __future__ import division
-from datetime import datetime
-from time import sleep, time
-import sys, signal, Adafruit_ADS1x15, sqlite3, numpy
-import logging
+from time import sleep, time, strftime, gmtime
+from glob import glob
+import sys, os, signal, socket, struct, sqlite3, json, numpy
+import logging, threading
+import eventstore    # Shared with the console watchdog
+from bisect import bisect_left
+try:
+    import Queue as queue
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    import queue
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+try:
+    from time import monotonic
+except ImportError:
+    # Python 2, read CLOCK_MONOTONIC through librt
+    import ctypes
+    class timespec(ctypes.Structure):
+        _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+    try:
+        clock_gettime = ctypes.CDLL('librt.so.1', use_errno=True).clock_gettime
+        clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+        def monotonic():
+            t = timespec()
+            clock_gettime(1, ctypes.byref(t))   # CLOCK_MONOTONIC = 1
+            return t.tv_sec + t.tv_nsec * 1e-9
+    except OSError:
+        monotonic = time
 
 #----- Basic Logging -----#
 #logging.basicConfig(stream=sys.stdout, level=logging.INFO)
@@ -23,8 +47,9 @@ logger = logging.getLogger(__name__)
 
 ssize = 1000        # Number of samples required for mVolt calibration
 blocksize = 100     # Sample size to send into stats
-bl = []
-ml = []
+mlalpha = None      # Weight of recent block means when recalibrating (e.g. 0.01), None = all time mean
+alertgap = 5000     # ms without an out of control sample that ends an excursion
+alertinterval = 60  # Min seconds between excursion log lines
 mm = 0
 uc = 0
 lc = 0
@@ -32,94 +57,673 @@ bls = 0
 blm = 0
 vres = .03          # %resolution of mVolt deviation in decimal (0.03 = 3%)
 cal = None
+calfile = '/home/admin/db/calibration.json'   # Calibration checkpoint, None = calibrate from scratch every start
+calinterval = 300   # Seconds between calibration checkpoints
+calmaxage = 6*3600  # Checkpoints older than this many seconds are stale and not restored
+faststart = False   # Without a checkpoint, check against limits from the first block while calibrating
+calsaved = 0
 dbfile = '/home/admin/db/power.db'    # File location for database
+eventfile = eventstore.eventfile    # Shared event store with the console watchdog, None disables it
+events = eventstore.EventStore(eventfile, 'power')     # Opened by the first event
+publish = events.publish
+commitrows = 200    # Rows buffered before a db commit (2 rows per block)
+commitinterval = 30 # Max seconds between db commits
+combinedtable = False   # Store voltage and current of a block as one row in power
+dbwriter = None
+rolluptables = ['voltage', 'current']   # Block tables with rollups
+# Rollup levels: table suffix, bucket width in ms, seconds to keep (None = forever)
+rollups = [('1m', 60000, 365*86400),
+           ('1h', 3600000, None),
+           ('1d', 86400000, None)]
+rawretention = None         # Seconds to keep raw block rows, None = forever
+pruneinterval = 3600        # Seconds between retention checks
+threaded = True     # Read the ADC on its own thread, process blocks on the main thread
+qsize = 4096        # Max raw samples buffered between acquisition and processing
+acquisition = None
+capturedir = None               # Directory for raw sample capture files, None = off
+capturemaxbytes = 64*2**20      # Rotate capture files at this size
+capturekeep = 100               # Number of capture files to keep
+capture = None
+metricsaddr = '127.0.0.1'   # Address for the metrics endpoint
+metricsport = 9102          # Port for http://metricsaddr:metricsport/metrics, None = off
+metricsfile = None          # Also write metrics to this file, e.g. for node_exporter
+metricsinterval = 15        # Seconds between metrics file writes
+
+#----- ADC acquisition -----#
+adcbackend = 'ads1115'  # 'ads1115', 'synthetic' or 'replay', see adcbackends
+replayfile = 'power-raw.txt'    # Raw samples for the replay backend
+adcmode = 'single'      # 'single' reads every channel single-shot
+                        # 'continuous' streams hpchannels at hprate
+
+# Maping of gain values to config register values.
+#    2/3: 0x0000,
+#    1:   0x0200,
+#    2:   0x0400,
+#    4:   0x0600,
+#    8:   0x0800,
+#    16:  0x0A00
+
+# Prefill all gain values as 1
+gain = [1]*4
+# Channel 0 is AMPS - use a different Gainvalue
+gain[0] = 0x0000
+
+# Mapping of data/sample rate to config register values for ADS1115 (slower).
+#    8:    0x0000,
+#    16:   0x0020,
+#    32:   0x0040,
+#    64:   0x0060,
+#    128:  0x0080,
+#    250:  0x00A0,
+#    475:  0x00C0,
+#    860:  0x00E0
+sample = 250
+
+# Continuous mode settings
+# A0 (current) and A3 (mV) are the channels stats() monitors
+hpchannels = [0, 3]     # High priority channels streamed in continuous mode
+hprate = 860            # Data rate for the high priority channels
+lpevery = 43            # Read the low priority channels once every N sweeps
+alertpin = None         # BCM GPIO wired to ALERT/RDY, None = wait one conversion
+
+#----- ADC conversion constants -----#
+# Choose a gain of 1 for reading voltages from 0 to 4.09V.
+# Or pick a different gain to change the range of voltages that are read:
+#  - 2/3 = +/-6.144V
+#  -   1 = +/-4.096V
+#  -   2 = +/-2.048V
+#  -   4 = +/-1.024V
+#  -   8 = +/-0.512V
+#  -  16 = +/-0.256V
+# Set the values of each gain
+gv = [4096]*4
+gv[0] = 6144
+
+# Bit size for 15-bit ADC single-ended read
+bitsize = 32767
+
+# Custom calc for chan 3
+# Calibrated with RasPi + Bridge
+ch3_ratio = 5000/31133
+
+# Middle value for AMP reading (Range = -5A to 5A)
+ampmid = 2560
+# mV/A constant for ACS714 chip
+ampconst = 185
+
+# Custom channel 1 ratio for adjusting voltage divider back to normal
+bwVDconst = 1.434659
+#bwVDconst = 1.48
+#bwVDconst = 1.439883
+#bwVDconst = 1.4518
+#bwVDconst = 1.4615
+#bwVDconst = 1.45455
+
+# Per channel scale and offset: converted = raw * chscale + choffset
+# A0 = Amps, A1/A2/A3 = mV
+chscale = numpy.array([gv[0]/bitsize/ampconst,
+                       gv[1]/bitsize*bwVDconst,
+                       gv[2]/bitsize,
+                       ch3_ratio*2])
+choffset = numpy.array([-ampmid/ampconst, 0, 0, 0])
+
+
+stopped = False
 
+def shutdown():
+    # Write out everything still buffered, only once
+    global stopped
+    if stopped: return
+    stopped = True
+    excursions.flush()
+    if capture is not None: capture.close()
+    if dbwriter is not None: dbwriter.close()
+    save_calibration()
+    events.close()
 
-def signal_handler(signal, frame):
-        print 'You pressed Ctrl+C!'
+def signal_handler(signum, frame):
+        # SIGINT and SIGTERM (systemctl stop), shutdown() runs on the way out
+        if signum == signal.SIGINT: print 'You pressed Ctrl+C!'
+        else: logger.info('Stopped by signal %d' %signum)
         sys.exit(0)
 
-def read_adc():
+class SampleClock(object):
+    # Sample timestamps from a monotonic clock anchored to the wall clock
+    # now_ms() = wall time at the anchor + monotonic time since the anchor
+    # so timestamps are cheap, sub-ms and never jump between samples
+    # Every checkevery seconds the projection is compared with the wall clock,
+    # a difference over steplimit seconds is a clock step (date -s, NTP):
+    # it is logged and counted and the clock re-anchors to the new wall time
+
+    def __init__(self, checkevery=10, steplimit=0.5):
+        self.checkevery = checkevery
+        self.steplimit = steplimit
+        self.steps = 0
+        self.anchor()
+
+    def anchor(self):
+        self.mono0 = monotonic()
+        self.wall0 = time()
+        self.lastcheck = self.mono0
+
+    def now_ms(self):
+        # Wall time in ms as a float
+        mono = monotonic()
+        if mono - self.lastcheck >= self.checkevery:
+            self.check(mono)
+        return (self.wall0 + (mono - self.mono0)) * 1000
+
+    def check(self, mono):
+        self.lastcheck = mono
+        step = time() - (self.wall0 + (mono - self.mono0))
+        if abs(step) > self.steplimit:
+            self.steps += 1
+            logger.warn("Wall clock stepped %+.3fs, re-anchoring sample clock" %step)
+            self.anchor()
+            publish('clockstep', value=step)
+            return step
+        return 0
+
+
+#----- Metrics -----#
+# Counters, gauges and histograms rendered in the Prometheus text format
+# Served on http://metricsaddr:metricsport/metrics and/or written to
+# metricsfile (for the node_exporter textfile collector)
+# Updates are plain attribute writes from several threads, a scrape can see
+# a histogram mid-update which is fine for monitoring
+
+class Counter(object):
+    kind = 'counter'
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.value = 0
+
+    def inc(self, n=1):
+        self.value += n
+
+    def samples(self):
+        return [(self.name, self.value)]
+
+
+class Gauge(object):
+    # fn is called on every render when given, for values owned elsewhere
+    kind = 'gauge'
+
+    def __init__(self, name, help, fn=None):
+        self.name = name
+        self.help = help
+        self.value = 0
+        self.fn = fn
+
+    def set(self, value):
+        self.value = value
+
+    def samples(self):
+        value = self.value
+        if self.fn is not None:
+            try:
+                value = self.fn()
+            except Exception:
+                value = float('nan')
+        return [(self.name, value)]
+
+
+class Histogram(object):
+    kind = 'histogram'
+    # Seconds, from 100us to 10s
+    defaultbuckets = (.0001, .00025, .0005, .001, .0025, .005, .01,
+                      .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+    def __init__(self, name, help, buckets=defaultbuckets):
+        self.name = name
+        self.help = help
+        self.buckets = list(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def samples(self):
+        out = []
+        total = 0
+        for le, n in zip(self.buckets + ['+Inf'], self.counts):
+            total += n
+            out.append(('%s_bucket{le="%s"}' %(self.name, le), total))
+        out.append((self.name + '_sum', self.sum))
+        out.append((self.name + '_count', self.count))
+        return out
+
+
+class Metrics(object):
+    # Registry of every metric, in the order they were created
+
+    def __init__(self):
+        self.metrics = []
+        self.lastwrite = 0
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help):
+        return self.add(Counter(name, help))
+
+    def gauge(self, name, help, fn=None):
+        return self.add(Gauge(name, help, fn))
+
+    def histogram(self, name, help, buckets=Histogram.defaultbuckets):
+        return self.add(Histogram(name, help, buckets))
+
+    def render(self):
+        lines = []
+        for m in self.metrics:
+            lines.append('# HELP %s %s' %(m.name, m.help))
+            lines.append('# TYPE %s %s' %(m.name, m.kind))
+            for name, value in m.samples():
+                lines.append('%s %r' %(name, float(value)))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, filename):
+        # Replace the file in one rename so readers never see half of it
+        tmp = filename + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(self.render())
+        os.rename(tmp, filename)
+        self.lastwrite = time()
+
+    def maybe_write(self):
+        # Write metricsfile at most every metricsinterval seconds
+        if metricsfile and time() - self.lastwrite >= metricsinterval:
+            try:
+                self.write(metricsfile)
+            except (IOError, OSError) as e:
+                logger.error("Metrics file: %s" %e)
+                self.lastwrite = time()
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = metrics.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Keep scrapes out of the log file
+        pass
+
+
+def start_metrics_server(addr, port):
+    # Serve metrics from a daemon thread, monitoring carries on without
+    # them when the port cannot be bound
+    try:
+        server = HTTPServer((addr, port), MetricsHandler)
+    except socket.error as e:
+        logger.error("Cannot serve metrics on %s:%d: %s" %(addr, port, e))
+        return None
+    t = threading.Thread(target=server.serve_forever, name='metrics-http')
+    t.daemon = True
+    t.start()
+    logger.info("Serving metrics on http://%s:%d/metrics" %(addr, port))
+    return server
+
+
+metrics = Metrics()
+m_samples = metrics.counter('power_samples_total', 'ADC samples processed')
+m_blocks = metrics.counter('power_blocks_total', 'Sample blocks processed')
+m_read = metrics.histogram('power_adc_read_seconds', 'Time to read one sweep of all channels over I2C')
+m_convert = metrics.histogram('power_convert_seconds', 'Time to convert one block of raw samples')
+m_stats = metrics.histogram('power_stats_seconds', 'Time in stats() for one block, including storeData()')
+m_store = metrics.histogram('power_store_seconds', 'Time in storeData() for one block')
+m_commit = metrics.histogram('power_db_commit_seconds', 'Time to commit one SQLite transaction')
+m_commitrows = metrics.counter('power_db_rows_total', 'Rows committed to the database')
+m_dberrors = metrics.counter('power_db_errors_total', 'Failed database commits')
+m_excursions = metrics.counter('power_excursions_total', 'Out of control voltage events')
+m_voltage = metrics.gauge('power_voltage_mv', 'Mean mVolts of the last block')
+m_current = metrics.gauge('power_current_amps', 'Mean Amps of the last block')
+m_calibrating = metrics.gauge('power_calibrating', '1 while the mVolt calibration is running')
+m_uc = metrics.gauge('power_voltage_uc_mv', 'Upper control limit in mVolts')
+m_lc = metrics.gauge('power_voltage_lc_mv', 'Lower control limit in mVolts')
+m_dropped = metrics.gauge('power_dropped_samples', 'Samples dropped because the queue was full',
+                          lambda: acquisition.dropped if acquisition else 0)
+m_queue = metrics.gauge('power_queue_depth', 'Samples waiting to be processed',
+                        lambda: acquisition.queue.qsize() if acquisition else 0)
+m_highwater = metrics.gauge('power_queue_highwater', 'Most samples ever waiting to be processed',
+                            lambda: acquisition.highwater if acquisition else 0)
+m_steps = metrics.gauge('power_clock_steps', 'Wall clock steps seen by the sample clock',
+                        lambda: clock.steps)
+
+
+class ADCBackend(object):
+    # Base class for ADC backends that stand in for Adafruit_ADS1x15.ADS1115
+    # Implements the driver calls used here: read_adc, start_adc,
+    # start_adc_comparator, get_last_result, stop_adc
+    # Subclasses only provide raw(channel)
+    # Conversions advance a virtual clock by 1/data_rate, with realtime=True
+    # every conversion also takes 1/data_rate of wall time like the chip
+
+    def __init__(self, realtime=False):
+        self.realtime = realtime
+        self.clock = 0.0
+        self.channel = None
+        self.rate = 128
+        self.started = 0
+
+    def raw(self, channel):
+        raise NotImplementedError
+
+    def convert(self, rate):
+        # Account for one conversion at rate
+        self.clock += 1.0/rate
+        if self.realtime: sleep(1.0/rate)
+
+    def read_adc(self, channel, gain=1, data_rate=None):
+        # Single-shot: config write then wait for the conversion
+        self.convert(data_rate or 128)
+        return self.raw(channel)
+
+    def start_adc(self, channel, gain=1, data_rate=None):
+        # Continuous: first result is ready one conversion after the config write
+        self.channel = channel
+        self.rate = data_rate or 128
+        self.started = time()
+        self.convert(self.rate)
+        return self.raw(channel)
+
+    def start_adc_comparator(self, channel, high_threshold, low_threshold,
+                             gain=1, data_rate=None, **kwargs):
+        # Continuous with the comparator, the driver also waits one
+        # conversion after the config write and returns its result
+        self.channel = channel
+        self.rate = data_rate or 128
+        self.started = time()
+        self.convert(self.rate)
+        return self.raw(channel)
+
+    def wait_ready(self, timeout=None):
+        # Emulates the ALERT/RDY pulse at the end of every conversion
+        self.clock += 1.0/self.rate
+        if self.realtime:
+            period = 1.0/self.rate
+            sleep(period - ((time() - self.started) % period))
+        return True
+
+    def get_last_result(self):
+        return self.raw(self.channel)
+
+    def stop_adc(self):
+        self.channel = None
+
+
+def to_raw(channel, value):
+    # Convert a value back into ADC counts, inverse of convert_raw_data()
+    v = (value - choffset[channel]) / chscale[channel]
+    return int(min(max(v, -32768), 32767))
+
+
+class SyntheticADC(ADCBackend):
+    # Generated readings for running the pipeline without hardware
+    # nominal is the converted value per channel: Amps, mV, mV, mV
+    # noise is gaussian noise in ADC counts
+    # steps are permanent changes: (start seconds, channel, delta)
+    # brownouts are temporary voltage drops on A1/A3:
+    #   (start seconds, duration seconds, depth as a fraction 0-1)
+    # Times are on the virtual conversion clock
+
+    def __init__(self, nominal=None, noise=8, steps=(), brownouts=(), realtime=False):
+        ADCBackend.__init__(self, realtime)
+        if nominal is None: nominal = [0.3, 5000, 0, 5100]
+        self.nominal = list(nominal)
+        self.noise = noise
+        self.steps = sorted(steps)
+        self.brownouts = list(brownouts)
+
+    def value(self, channel):
+        # Converted value on the virtual clock before noise
+        v = self.nominal[channel]
+        for start, ch, delta in self.steps:
+            if start > self.clock: break
+            if ch == channel: v += delta
+        if channel in (1, 3):
+            for start, duration, depth in self.brownouts:
+                if start <= self.clock < start + duration:
+                    v *= (1 - depth)
+        return v
+
+    def raw(self, channel):
+        v = self.value(channel)
+        if self.noise: v += numpy.random.normal(0, self.noise) * chscale[channel]
+        return to_raw(channel, v)
+
+
+class ReplayADC(ADCBackend):
+    # Replays recorded raw samples from a file as fast as they are read
+    # The file is text with one sample per line: A0, A1, A2, A3 [, timestamp]
+    # separated by commas or whitespace, '#' starts a comment,
+    # or a raw capture file (.bin) from RawCapture
+    # A row is consumed once a channel is requested a second time, so
+    # single-shot sweeps and continuous streaming both walk the file in order
+    # At the end of the file EOFError is raised unless loop=True
+
+    def __init__(self, filename, loop=False, realtime=False):
+        ADCBackend.__init__(self, realtime)
+        self.filename = filename
+        self.loop = loop
+        self.rows = self.load(filename)
+        if not len(self.rows):
+            raise ValueError('No samples in replay file: %s' %filename)
+        self.pos = 0
+        self.seen = set()
+
+    def load(self, filename):
+        if filename.endswith('.bin'):
+            return numpy.array(read_capture(filename)['ch'], dtype=numpy.int64)
+        with open(filename) as f:
+            lines = (l.replace(',', ' ') for l in f)
+            rows = numpy.loadtxt(lines, ndmin=2)
+        return rows[:,:4].astype(numpy.int64)
+
+    def raw(self, channel):
+        if channel in self.seen:
+            # Next sweep, move to the next row
+            self.pos += 1
+            self.seen = set()
+            if self.pos >= len(self.rows):
+                if not self.loop: raise EOFError('End of replay file: %s' %self.filename)
+                self.pos = 0
+        self.seen.add(channel)
+        return int(self.rows[self.pos, channel])
+
+
+def ads1115_backend():
+    # Import the driver here so the pipeline runs on machines without it
+    import Adafruit_ADS1x15
     # Create an ADS1115 ADC (16-bit) instance.
-    adc = Adafruit_ADS1x15.ADS1115()
+    return Adafruit_ADS1x15.ADS1115()
+
+
+# ADC backends by name, each entry is a function returning a new ADC
+adcbackends = {
+    'ads1115':   ads1115_backend,
+    'synthetic': lambda: SyntheticADC(realtime=True),
+    'replay':    lambda: ReplayADC(replayfile),
+    }
+
+
+# Timestamps for every sample
+clock = SampleClock()
+
+
+def make_adc(backend=None):
+    # Create the ADC selected by adcbackend
+    if backend is None: backend = adcbackend
+    if backend not in adcbackends:
+        raise ValueError('Unknown ADC backend: %s' %backend)
+    return adcbackends[backend]()
+
+
+def read_adc(adc=None):
+    # Create the ADC, an ADS1115 (16-bit) instance by default
+    if adc is None: adc = make_adc()
 
     # Read ADC channels
     # Yield the output as new values are obtained
-
-    # Maping of gain values to config register values.
-    #    2/3: 0x0000,
-    #    1:   0x0200,
-    #    2:   0x0400,
-    #    4:   0x0600,
-    #    8:   0x0800,
-    #    16:  0x0A00
-
-    # Prefill all gain values as 1
-    gain = [1]*4
-    # Channel 0 is AMPS - use a different Gainvalue
-    gain[0] = 0x0000
-
-    # Mapping of data/sample rate to config register values for ADS1115 (slower).
-    #    8:    0x0000,
-    #    16:   0x0020,
-    #    32:   0x0040,
-    #    64:   0x0060,
-    #    128:  0x0080,
-    #    250:  0x00A0,
-    #    475:  0x00C0,
-    #    860:  0x00E0
-    sample = 250
+    # values: A0, A1, A2, A3, timestamp in ms, then the time each channel
+    # was read in us relative to the timestamp
 
     # Read into a list
-    values = [0]*5
+    values = [0]*9
 
     while True:
+        # Timestamp as EPOCH in miliseconds taken at the start of the sweep
+        t0 = clock.now_ms()
         # Read in all 4 channels
         for i in range(4):
             # Read the specified ADC channel using the previously set gain value.
             values[i] = adc.read_adc(i, gain=gain[i], data_rate=sample)
+            values[5+i] = (clock.now_ms() - t0) * 1000
+
+        values[4] = t0
+        m_read.observe(values[8] / 1e6)
+        # Output the data as it comes in
+        yield values
+
+
+def alert_ready(adc):
+    # Return a function that blocks until the next conversion is ready
+    # Uses the ALERT/RDY pin when alertpin is set, otherwise waits one conversion
+    if hasattr(adc, 'wait_ready'):
+        return adc.wait_ready
+    if alertpin is not None:
+        import RPi.GPIO as GPIO
+        GPIO.setmode(GPIO.BCM)
+        GPIO.setup(alertpin, GPIO.IN, pull_up_down=GPIO.PUD_UP)
+        # ALERT/RDY pulses low at the end of every conversion
+        return lambda: GPIO.wait_for_edge(alertpin, GPIO.FALLING, timeout=100) is not None
+    return lambda: sleep(1.0/hprate) or True
+
 
-        # Add timestamp formated as EPOCH in miliseconds, then add as the last value
-        values[4] = int(datetime.now().strftime("%s")) * 1000
+def read_adc_continuous(adc=None):
+    # Stream the high priority channels in continuous conversion mode
+    # Low priority channels are read single-shot once every lpevery sweeps
+    # and keep their last value in between
+    # Only a single hpchannel really streams: with two or more every read
+    # switches channel and rewrites the config register, so it is the same
+    # as single-shot reads at hprate
+    if adc is None: adc = make_adc()
+
+    lpchannels = [i for i in range(4) if i not in hpchannels]
+    useready = alertpin is not None or hasattr(adc, 'wait_ready')
+    ready = alert_ready(adc)
+
+    # Same layout as read_adc(), low priority channels keep the time
+    # they were last read so their offsets go negative
+    values = [0]*9
+    chtime = [0]*4
+    current = None
+    sweep = 0
+
+    while True:
+        t0 = clock.now_ms()
+        if sweep % lpevery == 0 and lpchannels:
+            # Single-shot reads stop continuous mode
+            if current is not None: adc.stop_adc()
+            current = None
+            for i in lpchannels:
+                values[i] = adc.read_adc(i, gain=gain[i], data_rate=sample)
+                chtime[i] = clock.now_ms()
+
+        for i in hpchannels:
+            if i != current:
+                # Changing channel rewrites the config register, the driver
+                # waits for the first conversion and returns it
+                if useready:
+                    # Thresholds with MSB set/clear turn ALERT into conversion ready
+                    values[i] = adc.start_adc_comparator(i, 0x8000, 0x0000, gain=gain[i],
+                                                         data_rate=hprate)
+                else:
+                    values[i] = adc.start_adc(i, gain=gain[i], data_rate=hprate)
+                # Stay in continuous mode when there is only one channel to stream
+                current = i if len(hpchannels) == 1 else None
+            else:
+                # No config write, just wait for the next conversion
+                ready()
+                values[i] = adc.get_last_result()
+            chtime[i] = clock.now_ms()
+
+        # Timestamp as EPOCH in miliseconds, per channel offsets in us
+        values[4] = t0
+        for i in range(4):
+            values[5+i] = (chtime[i] - t0) * 1000
+        m_read.observe((clock.now_ms() - t0) / 1000)
+        sweep += 1
         # Output the data as it comes in
         yield values
 
 
+class Acquisition(threading.Thread):
+    # Read the ADC on its own thread so disk and numpy work never stall sampling
+    # Samples are pushed into a bounded queue, when full the sample is dropped
+    # dropped and highwater are kept for reporting
+
+    def __init__(self, readings, maxsize):
+        threading.Thread.__init__(self, name='adc-acquisition')
+        self.daemon = True
+        self.readings = readings
+        self.queue = queue.Queue(maxsize)
+        self.dropped = 0
+        self.highwater = 0
+        self.error = None
+
+    def run(self):
+        try:
+            for values in self.readings:
+                try:
+                    # read_adc() reuses its list, push a copy
+                    self.queue.put_nowait(tuple(values))
+                except queue.Full:
+                    self.dropped += 1
+                    continue
+                depth = self.queue.qsize()
+                if depth > self.highwater: self.highwater = depth
+        except Exception as e:
+            logger.error("ADC acquisition stopped: %s" %e)
+            self.error = e
+
+    def samples(self):
+        # Consumer side, yield samples in the order they were read
+        reported = 0
+        lastreport = 0
+        while True:
+            try:
+                yield self.queue.get(timeout=1)
+            except queue.Empty:
+                if not self.is_alive():
+                    raise RuntimeError("ADC acquisition thread died: %s" %self.error)
+                continue
+            # Report drops at most once a minute
+            if self.dropped > reported and time() - lastreport >= 60:
+                logger.warn("Dropped %d samples, queue high-water %d of %d" %(
+                            self.dropped - reported, self.highwater, self.queue.maxsize))
+                reported = self.dropped
+                lastreport = time()
+
+
 def convert_raw_data(values):
     # Read in raw binary values to be converted
     # Output will be a tuple of converted values
-
-    # Choose a gain of 1 for reading voltages from 0 to 4.09V.
-    # Or pick a different gain to change the range of voltages that are read:
-    #  - 2/3 = +/-6.144V
-    #  -   1 = +/-4.096V
-    #  -   2 = +/-2.048V
-    #  -   4 = +/-1.024V
-    #  -   8 = +/-0.512V
-    #  -  16 = +/-0.256V
-    # Set the values of each gain
-    gv = [4096]*4
-    gv[0] = 6144
-
-    # Bit size for 15-bit ADC single-ended read
-    bitsize = 32767
-
-    # Custom calc for chan 3
-    # Calibrated with RasPi + Bridge
-    ch3_ratio = 5000/31133
-
-    # Middle value for AMP reading (Range = -5A to 5A)
-    ampmid = 2560
-    # mV/A constant for ACS714 chip
-    ampconst = 185
-
-    # Custom channel 1 ratio for adjusting voltage divider back to normal
-    bwVDconst = 1.434659
-    #bwVDconst = 1.48
-    #bwVDconst = 1.439883
-    #bwVDconst = 1.4518
-    #bwVDconst = 1.4615
-    #bwVDconst = 1.45455
+    # Single sample path, the pipeline uses convert_raw_block()
 
     # A0 = Current
     # A1 = mV through NTE778a OpAmp with 1500+3300ohm voltage divider
@@ -133,26 +737,12 @@ def convert_raw_data(values):
 
     for i in range(4):
         # step through each channel
-        if i is 0:
-            # Convert to miliamps
-            vc = (values[i] * (gv[i]/bitsize))
-            amps = (vc - ampmid)/ampconst
+        v = (values[i] * chscale[i]) + choffset[i]
+        if i == 0:
             # Convert the number with percision of 2 decimals
-            ch[i] = round(amps,2)
-        elif i is 1:
-            # convert to mV
-            vdiv = (values[i] * (gv[i]/bitsize))
-            mvolts = vdiv * bwVDconst
-            ch[i] = int(mvolts)
-        elif i is 2:
-            # convert to mV
-            vdiv = (values[i] * (gv[i]/bitsize))
-            ch[i] = int(vdiv)
-        elif i is 3:
-            # convert to mV
-            vdiv = (values[i] * ch3_ratio)
-            mvolts = vdiv * 2
-            ch[i] = int(mvolts)
+            ch[i] = round(v,2)
+        else:
+            ch[i] = int(v)
 
     # Move the timestamp to the front
     ch.insert(0,values[4])
@@ -161,63 +751,741 @@ def convert_raw_data(values):
     return tuple(ch)
 
 
+def convert_raw_block(raw):
+    # Convert a whole block of raw readings at once
+    # raw is a numpy array of shape (N,5): A0, A1, A2, A3, timestamp
+    # any further columns (channel read times) are ignored
+    # Output is a float array of shape (N,5): timestamp, A0, A1, A2, A3
+    # matching the layout of convert_raw_data() rows
+
+    raw = numpy.asarray(raw, dtype=numpy.float64)
+    out = numpy.empty((raw.shape[0], 5), dtype=numpy.float64)
+
+    # Timestamp moves to the front
+    out[:,0] = raw[:,4]
+    # Scale and offset every channel in one pass
+    numpy.multiply(raw[:,:4], chscale, out=out[:,1:])
+    out[:,1:] += choffset
+    # Amps with percision of 2 decimals, mV truncated like int()
+    out[:,1] = numpy.round(out[:,1], 2)
+    numpy.trunc(out[:,2:], out=out[:,2:])
+
+    return out
+
+
+#----- Raw sample capture -----#
+# Capture files are append only: a 16 byte header then fixed width records
+#   ts  int64     sample timestamp, EPOCH in us
+#   ch  int16[4]  raw A0-A3 readings
+#   dt  int32[4]  time each channel was read, us relative to ts
+capturemagic = b'PWRRAW01'
+capturedtype = numpy.dtype([('ts', '<i8'), ('ch', '<i2', (4,)), ('dt', '<i4', (4,))])
+captureheader = 16
+
+
+class RawCapture(object):
+    # Append raw sample blocks to rotating capture files in directory
+    # Records are buffered and written bufrecords at a time so the SD card
+    # sees a few large writes, files rotate at maxbytes and only the newest
+    # keep files are kept
+
+    def __init__(self, directory, maxbytes=64*2**20, keep=100, bufrecords=4096):
+        self.directory = directory
+        self.maxbytes = maxbytes
+        self.keep = keep
+        self.buf = numpy.zeros(bufrecords, dtype=capturedtype)
+        self.n = 0
+        self.f = None
+        self.size = 0
+        if not os.path.isdir(directory): os.makedirs(directory)
+
+    def append(self, raw):
+        # raw is a block from read_adc(), shape (N,9)
+        raw = numpy.asarray(raw)
+        i = 0
+        while i < len(raw):
+            take = min(len(raw) - i, len(self.buf) - self.n)
+            rec = self.buf[self.n:self.n+take]
+            part = raw[i:i+take]
+            rec['ts'] = part[:,4] * 1000
+            rec['ch'] = part[:,:4]
+            rec['dt'] = part[:,5:9]
+            self.n += take
+            i += take
+            if self.n == len(self.buf): self.flush()
+
+    def flush(self):
+        if not self.n: return
+        if self.f is None or self.size >= self.maxbytes: self.rotate()
+        data = self.buf[:self.n].tobytes()
+        self.f.write(data)
+        self.f.flush()
+        self.size += len(data)
+        self.n = 0
+
+    def rotate(self):
+        # Start a new file named after its first record
+        if self.f is not None: self.f.close()
+        stamp = strftime('%Y%m%d-%H%M%S', gmtime(self.buf[0]['ts'] / 1e6))
+        n = 0
+        name = os.path.join(self.directory, 'raw-%s-%03d.bin' %(stamp, n))
+        while os.path.exists(name):
+            n += 1
+            name = os.path.join(self.directory, 'raw-%s-%03d.bin' %(stamp, n))
+        self.f = open(name, 'wb')
+        header = capturemagic + struct.pack('<II', capturedtype.itemsize, 0)
+        self.f.write(header)
+        self.size = len(header)
+        # Drop the oldest files
+        files = capture_files(self.directory)
+        for old in files[:max(0, len(files) - self.keep)]:
+            os.remove(old)
+
+    def close(self):
+        self.flush()
+        if self.f is not None: self.f.close()
+        self.f = None
+
+
+def capture_files(directory):
+    # Capture files oldest first, names sort by time
+    return sorted(glob(os.path.join(directory, 'raw-*.bin')))
+
+
+def read_capture(filename):
+    # Memory map a capture file as an array of records
+    # A partly written last record is left out
+    with open(filename, 'rb') as f:
+        header = f.read(captureheader)
+    if header[:8] != capturemagic:
+        raise ValueError('Not a raw capture file: %s' %filename)
+    recsize = struct.unpack('<I', header[8:12])[0]
+    if recsize != capturedtype.itemsize:
+        raise ValueError('Unknown record size %d in %s' %(recsize, filename))
+    count = (os.path.getsize(filename) - captureheader) // recsize
+    if not count:
+        return numpy.zeros(0, dtype=capturedtype)
+    return numpy.memmap(filename, dtype=capturedtype, mode='r',
+                        offset=captureheader, shape=(count,))
+
+
+def capture_slice(directory, start, end):
+    # Records with start <= ts < end (EPOCH in ms) from every capture file
+    # Timestamps are searched with a binary search, nothing is parsed
+    # Each file is assumed to be in time order, which holds unless the
+    # sample clock re-anchored backwards inside it
+    out = []
+    start = int(start * 1000)
+    end = int(end * 1000)
+    for filename in capture_files(directory):
+        rec = read_capture(filename)
+        if not len(rec) or rec[-1]['ts'] < start or rec[0]['ts'] >= end:
+            continue
+        ts = rec['ts']
+        a = numpy.searchsorted(ts, start, 'left')
+        b = numpy.searchsorted(ts, end, 'left')
+        if b > a: out.append(numpy.array(rec[a:b]))
+    if not out:
+        return numpy.zeros(0, dtype=capturedtype)
+    return numpy.concatenate(out)
+
+
+def capture_raw(records):
+    # Records back into read_adc() rows, shape (N,9), for convert_raw_block()
+    raw = numpy.empty((len(records), 9), dtype=numpy.float64)
+    raw[:,:4] = records['ch']
+    raw[:,4] = records['ts'] / 1000
+    raw[:,5:9] = records['dt']
+    return raw
+
+
+#----- Database schema -----#
+# Columns of every table written by DBWriter
+# timestamp/start/bucket = Unix EPOC time in ms
+blockcols = ['timestamp', 'mean', 'max', 'min', 'samples']
+rollupcols = ['bucket', 'mean', 'max', 'min', 'samples']
+tablecols = {
+    'voltage': blockcols,
+    'current': blockcols,
+    # Combined block row, one write per block instead of two
+    'power': ['timestamp', 'v_mean', 'v_max', 'v_min',
+              'i_mean', 'i_max', 'i_min', 'samples'],
+    'excursions': ['start', 'end', 'direction', 'peak', 'samples', 'limit_mv'],
+    }
+
+
+def columns(table):
+    # Column names of a table, rollup tables share one layout
+    if table in tablecols: return tablecols[table]
+    return rollupcols
+
+
+def schema_v1(conn):
+    # Named columns and time indexes
+    # Tables from before schema management have five positional columns,
+    # copy them into the new layout
+    for name in ('voltage', 'current'):
+        old = [c[1] for c in conn.execute("PRAGMA table_info(%s)" %name)]
+        if old and old != blockcols:
+            logger.info("Converting %s table to named columns" %name)
+            conn.execute("ALTER TABLE %s RENAME TO %s_v0" %(name,name))
+        conn.execute("CREATE TABLE IF NOT EXISTS %s (timestamp INTEGER NOT NULL, "
+                     "mean REAL, max REAL, min REAL, samples INTEGER)" %name)
+        if old and old != blockcols:
+            conn.execute("INSERT INTO %s SELECT * FROM %s_v0" %(name,name))
+            conn.execute("DROP TABLE %s_v0" %name)
+        conn.execute("CREATE INDEX IF NOT EXISTS %s_timestamp ON %s (timestamp)" %(name,name))
+
+    conn.execute("CREATE TABLE IF NOT EXISTS power (timestamp INTEGER NOT NULL, "
+                 "v_mean REAL, v_max REAL, v_min REAL, "
+                 "i_mean REAL, i_max REAL, i_min REAL, samples INTEGER)")
+    conn.execute("CREATE INDEX IF NOT EXISTS power_timestamp ON power (timestamp)")
+
+    conn.execute("CREATE TABLE IF NOT EXISTS excursions (start INTEGER, end INTEGER, "
+                 "direction TEXT, peak REAL, samples INTEGER, limit_mv REAL)")
+    conn.execute("CREATE INDEX IF NOT EXISTS excursions_start ON excursions (start)")
+
+
+def rollup_table(conn, name, suffix, width):
+    # Create a rollup table and fill it from the raw rows still in the db
+    # Combined power rows count for voltage and current like in DBWriter
+    # A bucket that already holds more samples keeps its row, its raw
+    # rows may be gone
+    table = '%s_%s' %(name, suffix)
+    conn.execute("CREATE TABLE IF NOT EXISTS %s (bucket INTEGER PRIMARY KEY, mean REAL, "
+                 "max REAL, min REAL, samples INTEGER) WITHOUT ROWID" %table)
+    cols = {'voltage': ('v_mean', 'v_max', 'v_min'),
+            'current': ('i_mean', 'i_max', 'i_min')}[name]
+    conn.execute("INSERT OR REPLACE INTO %(table)s "
+                 "SELECT b, SUM(m * n) / SUM(n), MAX(mx), MIN(mn), SUM(n) FROM ("
+                 "SELECT timestamp - timestamp %% %(width)d AS b, mean AS m, max AS mx, "
+                 "min AS mn, samples AS n FROM %(name)s UNION ALL "
+                 "SELECT timestamp - timestamp %% %(width)d, %(cols)s, samples FROM power) "
+                 "GROUP BY b HAVING SUM(n) > COALESCE("
+                 "(SELECT samples FROM %(table)s WHERE bucket = b), 0)"
+                 %{'table': table, 'width': width, 'name': name, 'cols': ', '.join(cols)})
+
+
+def schema_v2(conn):
+    # Rollup tables, backfilled from the raw rows kept so far so the
+    # history is there before anything is pruned
+    for name in rolluptables:
+        for suffix, width, keep in rollups:
+            logger.info("Filling %s_%s from raw rows" %(name, suffix))
+            rollup_table(conn, name, suffix, width)
+
+
+# Schema migrations in order, the position in the list is the schema version
+migrations = [schema_v1, schema_v2]
+
+
+def migrate(conn):
+    # Bring the database up to the latest schema version
+    # Every migration runs in its own transaction with its version row
+    conn.execute("CREATE TABLE IF NOT EXISTS schema_version "
+                 "(version INTEGER PRIMARY KEY, applied INTEGER)")
+    version = conn.execute("SELECT MAX(version) FROM schema_version").fetchone()[0] or 0
+    isolation = conn.isolation_level
+    # Manage transactions here so DDL does not commit halfway
+    conn.isolation_level = None
+    try:
+        for v, step in enumerate(migrations, 1):
+            if v <= version: continue
+            logger.info("Migrating database schema to version %d" %v)
+            conn.execute("BEGIN")
+            try:
+                step(conn)
+                conn.execute("INSERT INTO schema_version VALUES (?, ?)", (v, int(time()*1000)))
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+    finally:
+        conn.isolation_level = isolation
+    return len(migrations)
+
+
+class DBWriter(object):
+    # Long lived SQLite writer
+    # Keeps one connection open and batches rows into a single transaction
+    # Rows are committed when commitrows is reached or commitinterval expires
+    # Rows for rolluptables are also merged into the rollup tables
+    # name_1m, name_1h, name_1d: bucket, mean, max, min, samples
+    # Buckets are kept in memory and written with every commit
+
+    def __init__(self, dbfile, commitrows=200, commitinterval=30):
+        self.dbfile = dbfile
+        self.commitrows = commitrows
+        self.commitinterval = commitinterval
+        self.pending = {}
+        self.npending = 0
+        self.lastcommit = time()
+        self.queries = {}
+        self.conn = None
+        self.acc = {}
+        self.rollpending = {}
+        self.lastprune = 0
+
+    def open(self):
+        self.conn = sqlite3.connect(self.dbfile)
+        # WAL keeps readers working while we write and avoids rewriting pages
+        # synchronous=NORMAL only syncs the WAL on checkpoint, not every commit
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        migrate(self.conn)
+        # Rollup levels come from config, create and fill any that are missing
+        for name in rolluptables:
+            for suffix, width, keep in rollups:
+                if not self.conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' "
+                                         "AND name=?", ('%s_%s' %(name,suffix),)).fetchone():
+                    rollup_table(self.conn, name, suffix, width)
+        self.conn.commit()
+        self.lastcommit = time()
+        return self
+
+    def insert(self, name, row):
+        # Queue a row for table name
+        if name not in self.pending:
+            self.pending[name] = []
+        self.pending[name].append(row)
+        self.npending += 1
+        if name in rolluptables: self.rollup(name, row)
+        if name == 'power':
+            # Combined rows feed the same rollups as separate tables
+            self.rollup('voltage', row[0:4] + row[7:8])
+            self.rollup('current', row[0:1] + row[4:8])
+        if (self.npending >= self.commitrows or
+                time() - self.lastcommit >= self.commitinterval):
+            self.commit()
+
+    def query(self, name, verb='INSERT'):
+        # Build the INSERT statement once per table
+        key = (name, verb)
+        if key not in self.queries:
+            cols = columns(name)
+            # make some ? for use in SQL statement
+            qmarks = ', '.join('?' * len(cols))
+            self.queries[key] = "%s INTO %s (%s) VALUES (%s)" %(
+                verb, name, ', '.join(cols), qmarks)
+        return self.queries[key]
+
+    def rollup(self, name, row):
+        # Merge a block row (timestamp, mean, max, min, samples) into each rollup
+        ts, mean, vmax, vmin, n = row[:5]
+        for suffix, width, keep in rollups:
+            table = '%s_%s' %(name, suffix)
+            bucket = ts - ts % width
+            acc = self.acc.get(table)
+            if acc is None or acc[0] != bucket:
+                # Bucket finished, keep it for the next commit
+                if acc is not None: self.stage(table, acc)
+                acc = self.acc[table] = self.bucket(table, bucket)
+            # bucket, sum, max, min, samples
+            acc[1] += mean * n
+            acc[2] = vmax if acc[2] is None else max(acc[2], vmax)
+            acc[3] = vmin if acc[3] is None else min(acc[3], vmin)
+            acc[4] += n
+
+    def bucket(self, table, bucket):
+        # Continue a bucket that was already written, e.g. before a restart
+        row = self.rollpending.get(table, {}).get(bucket)
+        if row is None:
+            if self.conn is None: self.open()
+            row = self.conn.execute("SELECT bucket, mean, max, min, samples FROM %s "
+                                    "WHERE bucket=?" %table, (bucket,)).fetchone()
+        if row is None or not row[4]:
+            return [bucket, 0.0, None, None, 0]
+        return [bucket, row[1] * row[4], row[2], row[3], row[4]]
+
+    def stage(self, table, acc):
+        if not acc[4]: return
+        self.rollpending.setdefault(table, {})[acc[0]] = (
+            acc[0], acc[1] / acc[4], acc[2], acc[3], acc[4])
+
+    def prune(self):
+        # Drop rows older than their retention, at most every pruneinterval
+        now = time()
+        if now - self.lastprune < pruneinterval: return
+        self.lastprune = now
+        if rawretention:
+            cutoff = int((now - rawretention) * 1000)
+            for name in rolluptables + ['power']:
+                self.conn.execute("DELETE FROM %s WHERE timestamp < ?" %name, (cutoff,))
+        for name in rolluptables:
+            for suffix, width, keep in rollups:
+                if keep:
+                    cutoff = int((now - keep) * 1000)
+                    self.conn.execute("DELETE FROM %s_%s WHERE bucket < ?" %(name, suffix), (cutoff,))
+
+    def commit(self):
+        if self.conn is None: self.open()
+        # Current buckets are written as they are, later commits replace them
+        for table in self.acc:
+            self.stage(table, self.acc[table])
+        t = monotonic()
+        try:
+            for name in self.pending:
+                rows = self.pending[name]
+                if rows:
+                    self.conn.executemany(self.query(name), rows)
+            for table in self.rollpending:
+                rows = list(self.rollpending[table].values())
+                self.conn.executemany(self.query(table, 'INSERT OR REPLACE'), rows)
+            self.prune()
+            # Save the changes
+            self.conn.commit()
+            m_commitrows.inc(self.npending)
+        except Exception as e:
+            logger.error("SQL Execute: %s" %e)
+            self.conn.rollback()
+            m_dberrors.inc()
+        m_commit.observe(monotonic() - t)
+        self.pending = {}
+        self.npending = 0
+        self.rollpending = {}
+        self.lastcommit = time()
+
+    def close(self):
+        if self.conn is None: return
+        self.commit()
+        self.conn.close()
+        self.conn = None
+
+
+def pick_table(name, resolution=0, start=None):
+    # Table to read name from at resolution ms
+    # The coarsest rollup with buckets no wider than resolution, so long ranges
+    # read the fewest rows, skipping tables whose retention does not reach start
+    # Falls back to the raw block table, 'power' with combinedtable, or the
+    # finest rollup that still reaches start when raw rows are pruned
+    raw = 'power' if combinedtable else name
+    now = time()
+    reaches = lambda keep: not keep or start is None or start >= (now - keep) * 1000
+    best = raw if reaches(rawretention) else None
+    for suffix, width, keep in rollups:
+        if not reaches(keep): continue
+        if width <= resolution or best is None:
+            best = '%s_%s' %(name, suffix)
+    return best or raw
+
+
 def storeData(block):
-    global dbfile
+    global dbfile, dbwriter
     # SQLite store data
-    # Table Name: power
-    # DB file layout: timestamp, mean, max, min, samplesize
+    # Tables: voltage, current or power with combinedtable, see tablecols
+    # DB file layout: timestamp, mean, max, min, samples
     # timestamp = Unix EPOC time in ms
     #
     # Incoming data is dict of tuples
     #
 
-    conn=sqlite3.connect(dbfile)
-    curs=conn.cursor()
-
-    # make some ? for use in SQL statement
-    qmarks = ', '.join('?' * 5)
+    t = monotonic()
+    if dbwriter is None:
+        dbwriter = DBWriter(dbfile, commitrows, commitinterval).open()
 
     #print "%s" %block
 
     for name in block:
-        # Prepare the SQL Insert statement, make a list filled with ? for every value
-        query_string = "INSERT INTO %s VALUES (%s)" %(name,qmarks)
+        dbwriter.insert(name, block[name])
 
-        try:
-            curs.execute(query_string,block[name])
-        except Exception as e:
-            logger.error("SQL Execute: %s" %e)
-            conn.rollback()
-
-    # Save the changes
-    conn.commit()
-    # Close connection
-    conn.close
+    m_store.observe(monotonic() - t)
     return 1
 
 
+class StreamStats(object):
+    # Running statistics in constant memory and constant time per sample
+    # Welford mean/variance (population, like numpy.std) with min/max
+    # alpha   - also keep an exponentially weighted mean
+    # window  - also keep mean/variance over the last window values
+
+    def __init__(self, alpha=None, window=None):
+        self.alpha = alpha
+        self.window = window
+        self.reset()
+
+    def reset(self):
+        self.n = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = None
+        self.max = None
+        self.ewm = None
+        if self.window:
+            self.ring = numpy.zeros(self.window)
+            self.wpos = 0
+            self.wn = 0
+            self.wsum = 0.0
+            self.wsumsq = 0.0
+
+    def update(self, x):
+        # Add a single value
+        self.update_block(numpy.array([x], dtype=numpy.float64))
+
+    def update_block(self, values):
+        # Add an array of values, merged with Chan's parallel update
+        values = numpy.asarray(values, dtype=numpy.float64)
+        bn = len(values)
+        if not bn: return
+        bmean = values.mean()
+        bm2 = ((values - bmean)**2).sum()
+        n = self.n + bn
+        delta = bmean - self.mean
+        self.mean += delta * bn / n
+        self.m2 += bm2 + delta**2 * self.n * bn / n
+        self.n = n
+
+        bmin = values.min()
+        bmax = values.max()
+        if self.min is None or bmin < self.min: self.min = bmin
+        if self.max is None or bmax > self.max: self.max = bmax
+
+        if self.alpha:
+            # ewm = (1-a)^n * ewm + sum(a * (1-a)^(n-1-i) * x[i])
+            decay = 1 - self.alpha
+            weights = self.alpha * decay ** numpy.arange(bn-1, -1, -1)
+            if self.ewm is None:
+                # Seed with the first value
+                self.ewm = values[0]
+            self.ewm = decay**bn * self.ewm + (weights * values).sum()
+
+        if self.window:
+            self.update_window(values)
+
+    def update_window(self, values):
+        # Only the last window values can stay in the ring
+        values = values[-self.window:]
+        bn = len(values)
+        end = self.wpos + bn
+        if end <= self.window:
+            idx = slice(self.wpos, end)
+            old = self.ring[idx].copy()
+            self.ring[idx] = values
+        else:
+            idx = numpy.arange(self.wpos, end) % self.window
+            old = self.ring[idx]
+            self.ring[idx] = values
+        # Values being overwritten only count once the ring is full
+        nold = max(0, self.wn + bn - self.window)
+        old = old[bn-nold:] if nold else old[:0]
+        self.wsum += values.sum() - old.sum()
+        self.wsumsq += (values**2).sum() - (old**2).sum()
+        self.wn = min(self.window, self.wn + bn)
+        self.wpos = end % self.window
+
+    def state(self):
+        # Plain dict of the running stats, see restore()
+        st = {'n': int(self.n), 'mean': float(self.mean), 'm2': float(self.m2),
+              'min': None if self.min is None else float(self.min),
+              'max': None if self.max is None else float(self.max),
+              'ewm': None if self.ewm is None else float(self.ewm),
+              'alpha': self.alpha, 'window': self.window}
+        if self.window:
+            st.update(ring=self.ring.tolist(), wpos=self.wpos, wn=self.wn,
+                      wsum=self.wsum, wsumsq=self.wsumsq)
+        return st
+
+    def restore(self, st):
+        # Continue from state(), alpha and window must match
+        if st['alpha'] != self.alpha or st['window'] != self.window:
+            raise ValueError('StreamStats state is for alpha=%s window=%s' %(st['alpha'], st['window']))
+        self.n = st['n']
+        self.mean = st['mean']
+        self.m2 = st['m2']
+        self.min = st['min']
+        self.max = st['max']
+        self.ewm = st['ewm']
+        if self.window:
+            self.ring = numpy.array(st['ring'], dtype=numpy.float64)
+            self.wpos = st['wpos']
+            self.wn = st['wn']
+            self.wsum = st['wsum']
+            self.wsumsq = st['wsumsq']
+
+    @property
+    def variance(self):
+        return self.m2 / self.n if self.n else 0.0
+
+    @property
+    def std(self):
+        return self.variance ** 0.5
+
+    @property
+    def wmean(self):
+        return self.wsum / self.wn if self.window and self.wn else 0.0
+
+    @property
+    def wvariance(self):
+        if not self.window or not self.wn: return 0.0
+        m = self.wsum / self.wn
+        return max(0.0, self.wsumsq / self.wn - m*m)
+
+
+class Excursions(object):
+    # Coalesce out of control mVolt samples into events
+    # An event starts with the first sample over UC (or under LC) and ends
+    # once gap ms pass without another one
+    # Closed events are stored in the excursions table:
+    #   start, end, direction, peak, samples, limit
+    # Log lines are limited to one every interval seconds, the rest are counted
+
+    def __init__(self, gap=5000, interval=60):
+        self.gap = gap
+        self.interval = interval
+        self.active = {}
+        self.lastlog = 0
+        self.suppressed = 0
+
+    def log(self, msg):
+        now = time()
+        if now - self.lastlog < self.interval:
+            self.suppressed += 1
+            return
+        if self.suppressed:
+            msg += " (%d alerts suppressed)" %self.suppressed
+        logger.warn(msg)
+        self.lastlog = now
+        self.suppressed = 0
+
+    def check(self, ts, volt, uc, lc):
+        # ts and volt are the columns of a converted block
+        self.track('over', ts, volt, volt >= uc, uc)
+        self.track('under', ts, volt, volt <= lc, lc)
+
+    def track(self, direction, ts, volt, mask, limit):
+        ev = self.active.get(direction)
+        if not mask.any():
+            # Nothing out of control, end the event after the gap
+            if ev is not None and ts[-1] - ev[1] > self.gap:
+                self.close(direction)
+            return
+        hits = ts[mask]
+        vals = volt[mask]
+        peak = vals.max() if direction == 'over' else vals.min()
+        if ev is not None and hits[0] - ev[1] > self.gap:
+            self.close(direction)
+            ev = None
+        if ev is None:
+            # start, end, peak, samples, limit
+            self.active[direction] = [hits[0], hits[-1], peak, len(hits), limit]
+            self.log("mVolts: %.0f is %s %s(%.2f), excursion started" %(
+                     peak, direction, 'UC' if direction == 'over' else 'LC', limit))
+        else:
+            ev[1] = hits[-1]
+            ev[2] = max(ev[2], peak) if direction == 'over' else min(ev[2], peak)
+            ev[3] += len(hits)
+
+    def close(self, direction):
+        start, end, peak, count, limit = self.active.pop(direction)
+        m_excursions.inc()
+        self.log("mVolts: excursion %s %.2f ended after %.1fs, %d samples, peak %.0f" %(
+                 direction, limit, (end - start) / 1000, count, peak))
+        storeData({'excursions': (int(start), int(end), direction, float(peak), count, float(limit))})
+        publish('excursion', ts=start, value=float(peak), duration=end - start,
+                detail={'direction': direction, 'limit': float(limit), 'samples': int(count)})
+
+    def flush(self):
+        # Close every open event, used on shutdown
+        for direction in list(self.active):
+            self.close(direction)
+
+
+def reset_stats():
+    global mm, ml, uc, lc, bl, bls, blm, cal, excursions
+    # Forget calibration, the next block starts calibrating again
+    bl = StreamStats()
+    ml = StreamStats(alpha=mlalpha)
+    mm = 0
+    uc = 0
+    lc = 0
+    bls = 0
+    blm = 0
+    cal = None
+    excursions = Excursions(alertgap, alertinterval)
+
+# Calibration sample of mVolts and running stats of block means
+bl = StreamStats()
+ml = StreamStats(alpha=mlalpha)
+# Out of control events
+excursions = Excursions(alertgap, alertinterval)
+
+
+#----- Calibration checkpoint -----#
+# blm/bls/uc/lc and the running stats are saved to calfile every
+# calinterval seconds, after every calibration and on shutdown.
+# At startup a checkpoint newer than calmaxage, made with the same ssize,
+# blocksize and vres, is restored so UC/LC checks run from the first block; a
+# voltage change while stopped is caught by the 1% mean check in stats().
+
+def save_calibration(filename=None):
+    global calsaved
+    if filename is None: filename = calfile
+    if not filename or cal is None: return False
+    st = {'saved': time(), 'ssize': ssize, 'blocksize': blocksize, 'vres': vres,
+          'blm': float(blm), 'bls': float(bls), 'uc': float(uc), 'lc': float(lc),
+          'cal': cal, 'bl': bl.state(), 'ml': ml.state()}
+    tmp = filename + '.tmp'
+    try:
+        with open(tmp, 'w') as f:
+            json.dump(st, f)
+        os.rename(tmp, filename)
+    except (IOError, OSError) as e:
+        logger.warn("Could not save calibration to %s: %s" %(filename, e))
+        return False
+    calsaved = time()
+    return True
+
+def maybe_save_calibration():
+    if calfile and time() - calsaved >= calinterval:
+        save_calibration()
+
+def load_calibration(filename=None):
+    # Restore a fresh checkpoint, returns True when the state was used
+    global bl, ml, blm, bls, uc, lc, cal
+    if filename is None: filename = calfile
+    if not filename or not os.path.exists(filename): return False
+    try:
+        with open(filename) as f:
+            st = json.load(f)
+        age = time() - st['saved']
+        if not 0 <= age <= calmaxage:
+            logger.info("Calibration checkpoint is %.0fs old, calibrating from scratch" %age)
+            return False
+        if (st['ssize'], st['blocksize'], st['vres']) != (ssize, blocksize, vres):
+            logger.info("Calibration checkpoint was made with other settings, calibrating from scratch")
+            return False
+        newbl = StreamStats()
+        newml = StreamStats(alpha=mlalpha)
+        newbl.restore(st['bl'])
+        newml.restore(st['ml'])
+    except (IOError, ValueError, KeyError, TypeError) as e:
+        logger.warn("Could not load calibration from %s: %s" %(filename, e))
+        return False
+    bl = newbl
+    ml = newml
+    blm, bls, uc, lc, cal = st['blm'], st['bls'], st['uc'], st['lc'], st['cal']
+    logger.info("Calibration restored (%.0fs old): UC:%.2f  LC:%.2f  M:%.2f" %(age,uc,lc,blm))
+    publish('calibration', value=blm, detail={'uc': uc, 'lc': lc, 'std': bls, 'restored': True})
+    return True
+
+
 def stats(block):
-    global mm, ml, uc, lc, bl, bls, blm, ssize, vres, cal
+    global mm, ml, uc, lc, bl, bls, blm, ssize, vres, cal, excursions
     # Analyize the block and determine the mean with standard deviation
     # Each channel will need to be calculated
-    cur = []
-    volt = []
-    uvl = []
-    lvl = []
-    vlsize = len(bl)
+    # block is the converted array from convert_raw_block()
+    vlsize = bl.n
 
-    # create separate lists of volt and cur
-    for row in block:
-        cur.append(row[1])
-        volt.append(row[4])
+    # separate columns of volt and cur
+    cur = block[:,1]
+    volt = block[:,4]
 
     # pull dates, keep end date for data reference
-    ed = block[-1][0]
+    ed = int(block[-1,0])
 
-    # Keep a list of means for every sample, store with min,max
+    # Keep running stats of the mean of every block, store with min,max
     # mVolts
     mm = numpy.mean(volt)
-    ml.append(mm)
+    ml.update(mm)
     # Current
     cm = numpy.mean(cur)
 
@@ -228,12 +1496,19 @@ def stats(block):
         # Calibration process active bit
         cal = True
     # Grow the sample with every block, eventually the sample will be larger than ssize
-    if vlsize <= ssize: bl += volt
+    if vlsize <= ssize: bl.update_block(volt)
+    if vlsize is 0 and faststart and blm == 0:
+        # Preliminary limits from the first block until the calibration completes
+        blm = bl.mean
+        bls = bl.std
+        uc = blm + (blm*vres)
+        lc = blm - (blm*vres)
+        logger.info("Fast start limits: UC:%.2f  LC:%.2f  M:%.2f" %(uc,lc,blm))
     if vlsize == ssize:
         # Calibrate statisticial limits over X samples
         # Set standard divation and mean from the growing sample size
-        bls = numpy.std(bl)
-        blm = numpy.mean(bl)
+        bls = bl.std
+        blm = bl.mean
         # 3 units of Std Divation will set the control limits
         #uc = blm + (bls*3)
         #lc = blm - (bls*3)
@@ -241,7 +1516,10 @@ def stats(block):
         uc = blm + (blm*vres)
         lc = blm - (blm*vres)
         logger.info("Calibration completed: UC:%.2f  LC:%.2f  M:%.2f" %(uc,lc,blm))
+        publish('calibration', ts=ed, value=float(blm),
+                detail={'uc': float(uc), 'lc': float(lc), 'std': float(bls)})
         cal = False
+        save_calibration()
 
     if blm > 0:
         vm = numpy.mean(volt)
@@ -252,23 +1530,32 @@ def stats(block):
             # Reset calibration to adjust to new voltage
             # Only reset when calibration process is NOT running
             if cal is False:
-                blm = numpy.mean(ml)
-                bl = []
+                publish('recalibrate', ts=ed, value=float(vm), detail={'mean': float(blm)})
+                # Mean of all block means, or the weighted recent mean with mlalpha
+                blm = ml.ewm if mlalpha else ml.mean
+                bl.reset()
                 cal = True
-        for v in volt:
-            #Test if any value is out of control
-            if v >= uc: uvl.append(v)
-            if v <= lc: lvl.append(v)
-
-        if len(uvl): logger.warn("mVolts: %s is over UC(%.2f)" %(uvl,uc))
-        if len(lvl): logger.warn("mVolts: %s is under LC(%.2f)" %(lvl,lc))
+        #Test if any value is out of control
+        excursions.check(block[:,0], volt, uc, lc)
 
     # Build the dict for sending to db
-    out = {'voltage':(ed, mm, max(volt), min(volt), len(volt))}
+    vrow = (ed, mm, int(volt.max()), int(volt.min()), len(volt))
 
     ######### Current #################
     # Not checking for statistical anomilies, just store data
-    out['current'] = (ed, cm, max(cur), min(cur), len(cur))
+    crow = (ed, cm, float(cur.max()), float(cur.min()), len(cur))
+
+    m_voltage.set(mm)
+    m_current.set(cm)
+    m_calibrating.set(1 if cal else 0)
+    m_uc.set(uc)
+    m_lc.set(lc)
+
+    if combinedtable:
+        # One row per block: timestamp, v_mean, v_max, v_min, i_mean, i_max, i_min, samples
+        out = {'power': vrow[:4] + crow[1:]}
+    else:
+        out = {'voltage': vrow, 'current': crow}
 
     # Store readings into the db
     # db fields: EPOCHdate, mean, max, min, sample size
@@ -283,36 +1570,64 @@ def countData(ch):
     # Store average of each block
     # ~43 samples per sec (100 ~ 2.3 sec per write)
 
+    global capture
     c = 0
-    datablock = []
+    # Raw samples are collected in place, then converted as one block
+    rawblock = numpy.empty((blocksize, 9), dtype=numpy.float64)
+    if capturedir and capture is None:
+        capture = RawCapture(capturedir, capturemaxbytes, capturekeep)
     while True:
         for vlist in ch:
+            rawblock[c] = vlist
             c += 1
-            #convert data
-            vdata = convert_raw_data(vlist)
-            datablock.append(vdata)
-            if c is blocksize:
+            if c == blocksize:
                 #print "Storing %d points..." %c
-                #storeData(datablock)
+                # Keep the raw samples when capturing
+                if capture is not None: capture.append(rawblock)
+                #convert data
+                t = monotonic()
+                datablock = convert_raw_block(rawblock)
+                t1 = monotonic()
                 stats(datablock)
+                m_convert.observe(t1 - t)
+                m_stats.observe(monotonic() - t1)
+                m_samples.inc(blocksize)
+                m_blocks.inc()
+                metrics.maybe_write()
+                maybe_save_calibration()
                 # Reset count
                 c = 0
-                datablock = []
 
 
 def main():
+    global acquisition
+    if metricsport:
+        start_metrics_server(metricsaddr, metricsport)
+    # Pick up the calibration from the last run
+    load_calibration()
     # Start reading
-    readings = read_adc()
+    if adcmode == 'continuous':
+        readings = read_adc_continuous()
+    else:
+        readings = read_adc()
+    if threaded:
+        # Sample on a separate thread, convert/stats/store on this one
+        acquisition = Acquisition(readings, qsize)
+        acquisition.start()
+        readings = acquisition.samples()
     # Store data in blocks
     countData(readings)
     pass
 
 if __name__ == '__main__':
     signal.signal(signal.SIGINT, signal_handler)
+    signal.signal(signal.SIGTERM, signal_handler)
     try:
         logger.info('Started Power-Monitor...')
         main()
     except KeyboardInterrupt:
         logger.info('User interupt - Quitting Power-Monitor')
-        logger.shutdown
-        pass
+    finally:
+        # Flush buffered rows, capture and calibration however we stop
+        shutdown()
+        logging.shutdown()
@@ -0,0 +1,145 @@
+#-------------------------------------------------------------------------------
+# Name:        Power-Query.py
+# Purpose:      Read back voltage and current history from the Power-Monitor db
+#
+# Created:     Oct 18, 2026
+#
+# Updated:
+#-------------------------------------------------------------------------------
+#!/usr/bin/env python
+
+# Series are read from the coarsest table that fits the resolution (see
+# pick_table() in power-monitor.py) and aggregated by SQLite, rows are
+# streamed from the cursor so month long ranges never sit in memory.
+# Each row is: timestamp (ms), mean, max, min, samples
+#
+# Usage: power-query.py voltage --start 2026-10-01 --end 2026-11-01 --resolution 1h
+#        power-query.py current --start=-7d --format json --output current.json
+#
+# Times are epoch ms, 'YYYY-MM-DD[ HH:MM[:SS]]' local time, or relative to
+# now like -30m, -12h, -7d. Resolutions are ms or a number with s/m/h/d.
+
+from __future__ import division
+from os import path
+import sys, argparse, csv, json, sqlite3, numpy
+from loadscript import load_script
+from eventstore import parse_time, units
+
+# Columns of each series in the combined power table
+powercols = {'voltage': ('v_mean', 'v_max', 'v_min'),
+             'current': ('i_mean', 'i_max', 'i_min')}
+fields = ('timestamp', 'mean', 'max', 'min', 'samples')
+
+
+def connect(dbfile):
+    # Reader connection, never writes to the db
+    if not path.exists(dbfile):
+        raise IOError('No database at %s' %dbfile)
+    conn = sqlite3.connect(dbfile)
+    conn.execute('PRAGMA query_only=1')
+    return conn
+
+
+def series(conn, pm, name, start, end, resolution=0):
+    # Yield (timestamp, mean, max, min, samples) rows for name in [start, end)
+    # With a resolution rows are grouped into buckets of that many ms,
+    # the mean is weighted by the samples in every row
+    table = pm.pick_table(name, resolution, start)
+    if table == 'power':
+        ts = 'timestamp'
+        mean, vmax, vmin = powercols[name]
+    else:
+        ts = pm.columns(table)[0]
+        mean, vmax, vmin = 'mean', 'max', 'min'
+
+    if resolution:
+        sql = ("SELECT (%(ts)s / %(res)d) * %(res)d AS t, "
+               "SUM(%(mean)s * samples) / SUM(samples), MAX(%(max)s), MIN(%(min)s), SUM(samples) "
+               "FROM %(table)s WHERE %(ts)s >= ? AND %(ts)s < ? "
+               "GROUP BY t ORDER BY t")
+    else:
+        sql = ("SELECT %(ts)s, %(mean)s, %(max)s, %(min)s, samples "
+               "FROM %(table)s WHERE %(ts)s >= ? AND %(ts)s < ? ORDER BY %(ts)s")
+    sql = sql %{'ts': ts, 'res': int(resolution), 'mean': mean, 'max': vmax,
+                'min': vmin, 'table': table}
+
+    cursor = conn.execute(sql, (int(start), int(end)))
+    while True:
+        rows = cursor.fetchmany(1000)
+        if not rows: break
+        for row in rows:
+            yield row
+
+
+def arrays(rows, chunk=4096):
+    # Collect rows into a dict of numpy arrays keyed by field name
+    chunks = []
+    buf = numpy.empty((chunk, len(fields)), dtype=numpy.float64)
+    n = 0
+    for row in rows:
+        buf[n] = row
+        n += 1
+        if n == chunk:
+            chunks.append(buf)
+            buf = numpy.empty((chunk, len(fields)), dtype=numpy.float64)
+            n = 0
+    chunks.append(buf[:n])
+    data = numpy.concatenate(chunks)
+    out = dict((f, data[:,i]) for i, f in enumerate(fields))
+    out['timestamp'] = out['timestamp'].astype(numpy.int64)
+    out['samples'] = out['samples'].astype(numpy.int64)
+    return out
+
+
+def write_csv(rows, out):
+    writer = csv.writer(out)
+    writer.writerow(fields)
+    for row in rows:
+        writer.writerow(row)
+
+
+def write_json(rows, out):
+    # A JSON list of objects, written row by row
+    out.write('[')
+    sep = '\n'
+    for row in rows:
+        out.write(sep + json.dumps(dict(zip(fields, row)), sort_keys=True))
+        sep = ',\n'
+    out.write('\n]\n')
+
+
+def parse_resolution(value):
+    # ms, or a number with a s/m/h/d unit
+    if value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(value)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Read power-monitor history')
+    parser.add_argument('series', choices=['voltage', 'current'])
+    parser.add_argument('--db', help='database file, defaults to dbfile in power-monitor.py')
+    parser.add_argument('--start', type=parse_time, default='-1d')
+    parser.add_argument('--end', type=parse_time, default='now')
+    parser.add_argument('--resolution', type=parse_resolution, default=0,
+                        help='bucket width, 0 returns every stored block')
+    parser.add_argument('--format', choices=['csv', 'json'], default='csv')
+    parser.add_argument('--output', help='file to write, default stdout')
+    args = parser.parse_args()
+
+    pm = load_script('power_monitor', 'power-monitor.py')
+    conn = connect(args.db or pm.dbfile)
+    rows = series(conn, pm, args.series, args.start, args.end, args.resolution)
+    out = open(args.output, 'w') if args.output else sys.stdout
+    try:
+        if args.format == 'json':
+            write_json(rows, out)
+        else:
+            write_csv(rows, out)
+    finally:
+        if out is not sys.stdout: out.close()
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()